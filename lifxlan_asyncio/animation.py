@@ -0,0 +1,129 @@
+import asyncio
+import math
+from array import array
+
+from lifxlan.msgtypes import LightSetColor
+
+from lifxlan_asyncio.codec import COLOR
+
+try:
+    import numpy
+except ImportError:  # optional: frames are rendered one light at a time without it
+    numpy = None
+
+DEFAULT_FPS = 20  # one LightSetColor per device per frame: the whole of a device's 20 messages/s budget
+
+if numpy is not None:
+    # LightSetColor payload layout, so a whole animation packs with one assignment
+    COLOR_DTYPE = numpy.dtype([("reserved", "u1"), ("color", "<u2", (4,)), ("duration", "<u4")])
+    sin = numpy.sin
+else:
+    COLOR_DTYPE = None
+    sin = math.sin
+
+
+# Effects are functions of (t, index, count) -> (hue, saturation, brightness, kelvin),
+# t in seconds and index the light's position in the animation.
+# With numpy they are called once, with t a column and index a row of arrays, so stick to
+# arithmetic and the module's sin() and the same effect works on arrays and on plain numbers.
+
+def rainbow(period=5, saturation=65535, brightness=65535, kelvin=3500):
+    """ Hues cycling every period seconds, spread across the lights """
+    def effect(t, index, count):
+        return ((t / period + index / count) % 1) * 65535, saturation, brightness, kelvin
+    return effect
+
+
+def pulse(color, period=1, spread=0):
+    """ color breathing between off and full brightness; spread staggers the lights (0..1 of a period) """
+    hue, saturation, brightness, kelvin = color
+    def effect(t, index, count):
+        phase = 2 * math.pi * (t / period - spread * index / count)
+        return hue, saturation, brightness * (0.5 - 0.5 * sin(phase)), kelvin
+    return effect
+
+
+def render_frames(effect, count, num_frames, fps=DEFAULT_FPS):
+    """ Evaluate effect for every frame and light: num_frames x count x 4 HSBK values, row-major
+
+    A numpy uint16 array when numpy is available, otherwise a flat array('H').
+    """
+    if numpy is not None:
+        t = numpy.arange(num_frames, dtype=float)[:, None] / fps
+        index = numpy.arange(count, dtype=float)[None, :]
+        frames = numpy.empty((num_frames, count, 4), dtype=numpy.uint16)
+        for channel, values in enumerate(effect(t, index, count)):
+            frames[:, :, channel] = numpy.clip(numpy.rint(values), 0, 65535)
+        return frames
+    frames = array("H")
+    for frame in range(num_frames):
+        t = frame / fps
+        for index in range(count):
+            frames.extend(min(65535, max(0, int(round(value)))) for value in effect(t, index, count))
+    return frames
+
+
+class Animation:
+    """ Precomputed frames for a set of lights, played back on a fixed tick
+
+    Every frame is rendered and packed into LightSetColor payloads up front, so a tick
+    only stamps a header on each payload and hands it to the socket. Each frame fades
+    into the next over one tick, which hides the odd dropped packet.
+    """
+    def __init__(self, lights, effect, duration, fps=DEFAULT_FPS, smooth=True):
+        self.lights = list(lights)
+        self.fps = fps
+        self.num_frames = max(1, int(round(duration * fps)))
+        self.transition_ms = int(1000 / fps) if smooth else 0
+        self.frames = render_frames(effect, len(self.lights), self.num_frames, fps)
+        if numpy is not None:
+            payloads = numpy.zeros(self.frames.shape[:2], dtype=COLOR_DTYPE)
+            payloads["color"] = self.frames
+            payloads["duration"] = self.transition_ms
+            self.payloads = memoryview(payloads.tobytes())
+        else:
+            self.payloads = None
+
+    def payload(self, frame, index):
+        offset = frame * len(self.lights) + index
+        if self.payloads is not None:
+            return self.payloads[offset * COLOR.size:(offset + 1) * COLOR.size]
+        return COLOR.pack(*self.frames[offset * 4:offset * 4 + 4], self.transition_ms)
+
+    def send_frame(self, transport, frame):
+        """ Send one frame to every light, skipping (not queueing) any light that is out of rate budget """
+        for index, light in enumerate(self.lights):
+            if not transport.scheduler.try_acquire(light.mac_addr):
+                continue
+            msg = light.packet_template.encode_packed(LightSetColor, transport.next_seq_num(light.mac_addr), self.payload(frame, index))
+            for addr in light.addrs():
+                transport.sendto_nowait(msg, addr)
+
+    # Plays the animation repeat times (None: until cancelled). Returns the number of frames dropped to keep time.
+    async def play(self, repeat=1):
+        if not self.lights:
+            return 0
+        transport = await self.lights[0].get_transport()
+        loop = asyncio.get_running_loop()
+        tick = 1 / self.fps
+        total_frames = None if repeat is None else self.num_frames * repeat
+        dropped = 0
+        start = loop.time()
+        frame = 0
+        try:
+            while total_frames is None or frame < total_frames:
+                self.send_frame(transport, frame % self.num_frames)
+                next_frame = frame + 1
+                due = start + next_frame * tick
+                now = loop.time()
+                if now > due + tick:  # fell more than a frame behind: skip ahead rather than play catch-up
+                    behind = int((now - start) / tick)
+                    dropped += behind - next_frame
+                    next_frame = behind
+                    due = start + next_frame * tick
+                frame = next_frame
+                await asyncio.sleep(max(0, due - loop.time()))
+        finally:
+            for light in self.lights:
+                light.cache.invalidate(LightSetColor)
+        return dropped
@@ -1,6 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
+DEFAULT_MAX_WORKERS = 1  # only the rare truly blocking calls (e.g. enumerating interfaces) use threads at all
+
+executor = None
+
+
+def get_executor():
+    """ The bounded executor run_async uses, created on first use unless set_executor() chose one """
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="lifxlan_asyncio")
+    return executor
+
+
+def set_executor(new_executor):
+    """ Use new_executor for blocking calls from now on; the previous one is not shut down """
+    global executor
+    executor = new_executor
+
 
 async def run_async(loop, func, *args, **kwargs):
-    """ Run a sync function in an async loop """
-    return loop.run_in_executor(None, partial(func, *args, **kwargs))
\ No newline at end of file
+    """ Run a blocking sync function on the bounded executor, keeping the loop free """
+    return await loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
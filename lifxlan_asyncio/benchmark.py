@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+from time import perf_counter
+
+from lifxlan.errors import WorkflowException
+
+from lifxlan_asyncio.lifxlan_asyncio import AsyncLifxLAN
+from lifxlan_asyncio.ratelimit import DEFAULT_RATE_LIMIT
+from lifxlan_asyncio.simulator import make_bulbs, start_fleet
+
+DEFAULT_FLEET_SIZES = [1, 10, 50, 100]
+DEFAULT_REQUESTS_PER_DEVICE = 20
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+async def timed(coro):
+    start = perf_counter()
+    result = await coro
+    return result, perf_counter() - start
+
+
+async def run(size, requests_per_device=DEFAULT_REQUESTS_PER_DEVICE, latency=0.0, jitter=0.0, loss=0.0,
+              rate_limit=DEFAULT_RATE_LIMIT, multizone_count=0, tile_count=0, seed=None):
+    """ Benchmark one AsyncLifxLAN against a fleet of size simulated devices; returns a dict of results """
+    bulbs = make_bulbs(size - multizone_count - tile_count, multizone_count, tile_count, rate_limit=rate_limit)
+    fleet = await start_fleet(bulbs, latency=latency, jitter=jitter, loss=loss, seed=seed)
+    lan = AsyncLifxLAN(num_lights=size, rate_limit=rate_limit, broadcast_addrs=["127.0.0.1"], broadcast_port=fleet.port)
+    try:
+        devices, discovery = await timed(lan.get_lights())
+        failures, refresh = await timed(lan.refresh_all())
+        power_levels, broadcast_get = await timed(lan.get_power_all_lights())
+
+        latencies = []
+        timeouts = 0
+
+        async def request(device):
+            nonlocal timeouts
+            for _ in range(requests_per_device):
+                start = perf_counter()
+                try:
+                    await device.get_power(max_age=0)
+                except WorkflowException:
+                    timeouts += 1
+                else:
+                    latencies.append(perf_counter() - start)
+
+        _, elapsed = await timed(asyncio.gather(*(request(d) for d in devices)))
+    finally:
+        lan.close()
+        fleet.close()
+    return {
+        "size": size,
+        "discovered": len(devices),
+        "discovery_s": discovery,
+        "refresh_s": refresh,
+        "refresh_failures": len(failures),
+        "broadcast_get_s": broadcast_get,
+        "broadcast_answers": len(power_levels),
+        "requests_per_s": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "timeouts": timeouts,
+        "retried": lan.metrics.retried,
+        "dropped": lan.metrics.dropped,
+        "simulator": dict(fleet.stats),
+    }
+
+
+def format_row(result):
+    def ms(value):
+        return "-" if value is None else "{:.1f}".format(value)
+    return "{size:>6} {discovered:>6} {discovery:>10} {refresh:>10} {broadcast:>10} {rps:>9} {p50:>8} {p99:>8} {timeouts:>8} {retried:>8}".format(
+        size=result["size"], discovered=result["discovered"],
+        discovery=ms(result["discovery_s"] * 1000), refresh=ms(result["refresh_s"] * 1000),
+        broadcast=ms(result["broadcast_get_s"] * 1000), rps=ms(result["requests_per_s"]),
+        p50=ms(result["p50_ms"]), p99=ms(result["p99_ms"]), timeouts=result["timeouts"], retried=result["retried"])
+
+
+HEADER = "{:>6} {:>6} {:>10} {:>10} {:>10} {:>9} {:>8} {:>8} {:>8} {:>8}".format(
+    "size", "found", "discover", "refresh", "get_all", "req/s", "p50", "p99", "timeouts", "retried")
+
+
+async def main(args):
+    print("times in ms")
+    print(HEADER)
+    for size in args.sizes:
+        result = await run(size, args.requests, args.latency / 1000, args.jitter / 1000, args.loss,
+                           None if args.no_rate_limit else DEFAULT_RATE_LIMIT, args.multizone, args.tiles, args.seed)
+        print(format_row(result))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark AsyncLifxLAN against simulated LIFX devices on localhost")
+    parser.add_argument("sizes", nargs="*", type=int, default=DEFAULT_FLEET_SIZES, help="fleet sizes to run")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS_PER_DEVICE, help="get_power requests per device")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated one-way reply latency, ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency of up to this many ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that any one packet is lost")
+    parser.add_argument("--multizone", type=int, default=0, help="how many of each fleet are multizone strips")
+    parser.add_argument("--tiles", type=int, default=0, help="how many of each fleet are tile chains")
+    parser.add_argument("--seed", type=int, default=None, help="seed for simulated jitter and loss")
+    parser.add_argument("--no-rate-limit", action="store_true", help="lift the 20 msg/s limit on both ends")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,53 @@
+from time import monotonic
+
+from lifxlan.errors import WorkflowException
+
+DEFAULT_FAILURE_THRESHOLD = 3  # consecutive failed requests that open the circuit
+DEFAULT_PROBE_INTERVAL = 5     # seconds between requests let through to an open circuit
+
+
+class CircuitOpenException(WorkflowException):
+    """ Raised instead of sending to a device whose circuit is open """
+    pass
+
+
+class CircuitBreaker:
+    """ Per-device circuit breaker
+
+    After threshold consecutive failures the circuit opens: requests fail at once
+    instead of each waiting out its full retransmit budget, except for one request
+    per probe_interval that goes through as a probe. Any success closes it again.
+    """
+    def __init__(self, threshold=DEFAULT_FAILURE_THRESHOLD, probe_interval=DEFAULT_PROBE_INTERVAL):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.next_probe = 0
+
+    @property
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def allow(self):
+        """ Whether a request may be sent now; while open, True once per probe_interval """
+        if not self.is_open:
+            return True
+        now = monotonic()
+        if now < self.next_probe:
+            return False
+        self.next_probe = now + self.probe_interval
+        return True
+
+    def probe_delay(self):
+        return max(0, self.next_probe - monotonic())
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        """ Count a failure, returning True if it is the one that opened the circuit """
+        self.failures += 1
+        if self.failures == self.threshold:
+            self.next_probe = monotonic() + self.probe_interval
+            return True
+        return False
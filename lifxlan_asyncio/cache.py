@@ -0,0 +1,65 @@
+from time import monotonic
+
+from lifxlan.msgtypes import LightSetColor, LightSetPower, LightSetWaveform, LightState, LightStatePower, \
+    MultiZoneSetExtendedColorZones, SetLabel, SetPower, SetTileState64, StateGroup, StateHostFirmware, StateInfo, \
+    StateLabel, StateLocation, StatePower, StateVersion, StateWifiFirmware, StateWifiInfo
+
+FOREVER = float("inf")
+
+# How long (seconds) a response may be served from the cache when the caller doesn't pass max_age.
+# Firmware and product never change under a running device; power and color change all the time.
+DEFAULT_TTLS = {
+    StateVersion: FOREVER,
+    StateHostFirmware: FOREVER,
+    StateWifiFirmware: FOREVER,
+    StateLabel: 60,
+    StateGroup: 60,
+    StateLocation: 60,
+    StatePower: 1,
+    LightStatePower: 1,
+    LightState: 1,
+    StateWifiInfo: 0,
+    StateInfo: 0,
+}
+
+# Cached responses made stale by a Set
+INVALIDATED_BY = {
+    SetLabel: [StateLabel, LightState],
+    SetPower: [StatePower, LightStatePower, LightState],
+    LightSetPower: [StatePower, LightStatePower, LightState],
+    LightSetColor: [LightState],
+    LightSetWaveform: [LightState],
+    MultiZoneSetExtendedColorZones: [LightState],
+    SetTileState64: [LightState],
+}
+
+MISSING = object()
+
+
+class StateCache:
+    """ Per-device cache of the latest response of each State type, with per-type TTLs """
+    def __init__(self, ttls=None):
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.entries = {}
+
+    def get(self, response_type, max_age=None):
+        """ Cached response no older than max_age (default: the type's TTL), else MISSING """
+        if max_age is None:
+            max_age = self.ttls.get(response_type, 0)
+        entry = self.entries.get(response_type)
+        if entry is None or monotonic() - entry[0] > max_age:
+            return MISSING
+        return entry[1]
+
+    def put(self, response):
+        self.entries[type(response)] = (monotonic(), response)
+
+    def invalidate(self, msg_type):
+        """ Drop every cached response a msg_type Set may have changed """
+        for response_type in INVALIDATED_BY.get(msg_type, ()):
+            self.entries.pop(response_type, None)
+
+    def clear(self):
+        self.entries.clear()
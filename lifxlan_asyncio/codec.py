@@ -0,0 +1,146 @@
+import struct
+import sys
+from array import array
+from itertools import chain
+
+from lifxlan.message import BROADCAST_MAC, HEADER_SIZE_BYTES
+from lifxlan.msgtypes import MSG_IDS, LightSetColor, LightSetPower, LightSetWaveform, SetLabel, SetPower, StateWifiInfo
+from lifxlan.unpack import unpack_lifx_message
+
+try:
+    import numpy
+except ImportError:  # optional: color buffers are packed through array('H') without it
+    numpy = None
+
+# Frame, frame address and protocol header in one go:
+# size, flags (protocol 1024, addressable, tagged), source, target (6 byte MAC + 2 pad), 6 reserved,
+# ack/res flags, sequence, 8 reserved, message type, 2 reserved
+HEADER = struct.Struct("<HHI6s2x6xBB8xH2x")
+PEEK = struct.Struct("<4xI6s9xB8xH")  # source, target MAC, sequence, message type
+FLAGS_OFFSET = 22
+SEQ_NUM_OFFSET = 23
+PROTOCOL_FLAGS = 1024 | 1 << 12  # protocol number, addressable
+TAGGED_FLAG = 1 << 13
+
+COLOR = struct.Struct("<xHHHHI")
+WAVEFORM = struct.Struct("<xBHHHHIfhB")
+POWER = struct.Struct("<H")
+LIGHT_POWER = struct.Struct("<HI")
+WIFI_INFO = struct.Struct("<fIIh")
+EXTENDED_COLOR_ZONES = struct.Struct("<IBHB")  # duration, apply, first zone index, colors count; then 82 colors
+SET_TILE_STATE_64 = struct.Struct("<BBxBBBI")  # tile index, length, reserved, x, y, width, duration; then 64 colors
+HSBK_SIZE = 8
+EXTENDED_ZONE_COUNT = 82  # colors in one SetExtendedColorZones, whatever the count field says
+TILE_ZONE_COUNT = 64      # colors in one SetTileState64: a whole 8x8 tile
+
+
+def pack_label(payload):
+    return payload["label"].encode("utf-8")[:32].ljust(32, b"\0")
+
+
+# struct packers for the messages on the hot path, byte-for-byte what lifxlan's bitstring packing produces
+PAYLOAD_PACKERS = {
+    LightSetColor: lambda p: COLOR.pack(*p["color"], p["duration"]),
+    LightSetWaveform: lambda p: WAVEFORM.pack(p["transient"], *p["color"], p["period"], p["cycles"], p["duty_cycle"], p["waveform"]),
+    SetPower: lambda p: POWER.pack(p["power_level"]),
+    LightSetPower: lambda p: LIGHT_POWER.pack(p["power_level"], p["duration"]),
+    SetLabel: pack_label,
+}
+
+
+def pack_colors(colors):
+    """ HSBK colors -> little-endian uint16 bytes, in one conversion
+
+    colors may be an n x 4 numpy array, a flat array('H') or any sequence of 4-value colors.
+    """
+    if numpy is not None and isinstance(colors, numpy.ndarray):
+        return numpy.ascontiguousarray(colors, dtype="<u2").tobytes()
+    if not isinstance(colors, array) or colors.typecode != "H":
+        colors = array("H", chain.from_iterable(colors))
+    if sys.byteorder == "big":
+        colors = array("H", colors)
+        colors.byteswap()
+    return colors.tobytes()
+
+
+def split_colors(packed, per_packet):
+    """ Cut packed colors into (first index, count, colors padded to per_packet) chunks, one per packet """
+    packed = memoryview(packed)
+    chunk_size = per_packet * HSBK_SIZE
+    for offset in range(0, len(packed), chunk_size):
+        chunk = bytes(packed[offset:offset + chunk_size])
+        yield offset // HSBK_SIZE, len(chunk) // HSBK_SIZE, chunk.ljust(chunk_size, b"\0")
+
+
+def pack_payload(msg_type, payload):
+    if not payload:
+        return b""
+    if isinstance(payload, (bytes, bytearray, memoryview)):  # already packed
+        return payload
+    packer = PAYLOAD_PACKERS.get(msg_type)
+    if packer is not None:
+        return packer(payload)
+    # anything else: let lifxlan build it and keep the payload
+    return msg_type(BROADCAST_MAC, 0, 0, payload).packed_message[HEADER_SIZE_BYTES:]
+
+
+def unpack_message(data, msg_id):
+    """ unpack_lifx_message, working around messages lifxlan can't rebuild from what it decoded """
+    if msg_id == MSG_IDS[StateWifiInfo]:
+        # lifxlan reads the signal (mW) as a float and then fails to pack it back as an integer
+        source_id, target, seq_num, _ = PEEK.unpack_from(data)
+        signal, tx, rx, reserved1 = WIFI_INFO.unpack_from(data, HEADER_SIZE_BYTES)
+        flags = data[FLAGS_OFFSET]
+        payload = {"signal": 0, "tx": tx, "rx": rx, "reserved1": reserved1}
+        message = StateWifiInfo(target.hex(":"), source_id, seq_num, payload, bool(flags & 2), bool(flags & 1))
+        message.signal = signal
+        return message
+    return unpack_lifx_message(data)
+
+
+def peek_header(data):
+    """ (source id, target MAC, sequence number, message type id) without decoding the packet """
+    source_id, target, seq_num, msg_id = PEEK.unpack_from(data)
+    return source_id, target.hex(":"), seq_num, msg_id
+
+
+class Packet:
+    """ An encoded message, ready for the wire """
+    __slots__ = ("msg_type", "target_addr", "packed_message")
+
+    def __init__(self, msg_type, target_addr, packed_message):
+        self.msg_type = msg_type
+        self.target_addr = target_addr
+        self.packed_message = packed_message
+
+    def __str__(self):
+        return str(unpack_lifx_message(bytes(self.packed_message)))
+
+
+class PacketTemplate:
+    """ Per-target header templates: everything but the flags, sequence number and payload is built once """
+    def __init__(self, target_addr, source_id):
+        self.target_addr = target_addr
+        self.source_id = source_id
+        self.flags = PROTOCOL_FLAGS | (TAGGED_FLAG if target_addr == BROADCAST_MAC else 0)
+        self.target = bytes.fromhex(target_addr.replace(":", ""))
+        self.headers = {}  # (msg_type, payload size) -> header bytes
+
+    def header(self, msg_type, payload_size):
+        key = (msg_type, payload_size)
+        header = self.headers.get(key)
+        if header is None:
+            size = HEADER_SIZE_BYTES + payload_size
+            header = self.headers[key] = HEADER.pack(size, self.flags, self.source_id, self.target, 0, 0, MSG_IDS[msg_type])
+        return header
+
+    def encode(self, msg_type, seq_num, payload={}, ack_requested=False, response_requested=False):
+        return self.encode_packed(msg_type, seq_num, pack_payload(msg_type, payload), ack_requested, response_requested)
+
+    def encode_packed(self, msg_type, seq_num, payload, ack_requested=False, response_requested=False):
+        """ encode() for a payload that is already packed (bytes or a memoryview of them) """
+        packet = bytearray(self.header(msg_type, len(payload)))
+        packet[FLAGS_OFFSET] = (2 if ack_requested else 0) | (1 if response_requested else 0)
+        packet[SEQ_NUM_OFFSET] = seq_num
+        packet += payload
+        return Packet(msg_type, self.target_addr, packet)
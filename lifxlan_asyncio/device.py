@@ -1,20 +1,97 @@
 import asyncio
 import logging
+from datetime import datetime
 
 import lifxlan
+from lifxlan.device import DEFAULT_ATTEMPTS, DEFAULT_TIMEOUT
+from lifxlan.errors import WorkflowException
+from lifxlan.msgtypes import Acknowledgement, GetGroup, GetHostFirmware, GetInfo, GetLabel, GetLocation, GetPower, \
+    GetVersion, GetWifiFirmware, GetWifiInfo, LightSetColor, LightSetInfrared, LightSetPower, LightSetWaveform, SetLabel, \
+    SetPower, StateGroup, StateHostFirmware, StateInfo, StateLabel, StateLocation, StatePower, StateVersion, \
+    StateWifiFirmware, StateWifiInfo
+from lifxlan.products import features_map, light_products, product_map, switch_products
+
+from lifxlan_asyncio.breaker import CircuitBreaker, CircuitOpenException
+from lifxlan_asyncio.cache import MISSING, StateCache
+from lifxlan_asyncio.codec import PacketTemplate, pack_payload
+from lifxlan_asyncio.interfaces import get_broadcast_addrs
+from lifxlan_asyncio.rtt import RttEstimator
+from lifxlan_asyncio.transport import AsyncTransport
 
-from lifxlan_asyncio.async_helpers import run_async
+UDP_BROADCAST_PORT = lifxlan.UDP_BROADCAST_PORT
 
+# Sets that fully replace whatever state they set, so only the newest pending one is worth sending.
+# Maps each to the state it sets: Sets of one state replace each other whatever their type.
+COALESCED_STATES = {
+    SetLabel: SetLabel,
+    SetPower: SetPower,
+    LightSetPower: SetPower,
+    LightSetColor: LightSetColor,
+    LightSetWaveform: LightSetColor,
+    LightSetInfrared: LightSetInfrared,
+}
 
-async def get_broadcast_addrs(loop=asyncio.get_event_loop()):
-    return await run_async(loop, lifxlan.get_broadcast_addrs)
 
-UDP_BROADCAST_IP_ADDRS = await get_broadcast_addrs()
-UDP_BROADCAST_PORT = lifxlan.UDP_BROADCAST_PORT
+def is_running(task):
+    """ Whether task is still going on the running loop; one left behind on a loop that is gone never finishes """
+    return task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop()
 
 
 class AsyncDevice(lifxlan.Device):
-    async def refresh(self):
+    def __init__(self, mac_addr, ip_addr, service, port, source_id, verbose=False, transport=None, broadcast_addrs=None):
+        super().__init__(mac_addr, ip_addr, service, port, source_id, verbose)
+        self.transport = transport
+        self.owns_transport = False  # whether get_transport() opened a private one, which close() then closes
+        self.broadcast_addrs = broadcast_addrs  # where to send while ip_addr is unknown; shared with the owning AsyncLifxLAN
+        self.interface = None  # the local Interface on this device's subnet, if known
+        self.cache = StateCache()
+        self.rtt = RttEstimator()
+        self.breaker = CircuitBreaker()
+        self.probe_task = None
+        self.packet_template = PacketTemplate(mac_addr, source_id)
+        # fire-and-forget Sets waiting for a send slot: state -> [msg_type, payload, repeats left, future], oldest first
+        self.outbound = {}
+        self.outbound_task = None
+
+    @property
+    def metrics(self):
+        """ This device's DeviceMetrics, None until it has a transport """
+        if self.transport is None:
+            return None
+        return self.transport.metrics.device(self.mac_addr)
+
+    async def get_transport(self):
+        """ Shared endpoint of the owning AsyncLifxLAN, or a private one for standalone devices """
+        if self.transport is None:
+            self.transport = AsyncTransport(verbose=self.verbose)
+            self.owns_transport = True
+        if self.broadcast_addrs is None and not self.ip_addr:
+            self.broadcast_addrs = await get_broadcast_addrs()
+        return await self.transport.open()
+
+    # lifxlan's blocking per-request sockets, replaced by the long-lived transport: initialize_socket() opens it,
+    # close_socket() is close(); timeout is only accepted for compatibility, requests carry their own
+    async def initialize_socket(self, timeout=None):
+        return await self.get_transport()
+
+    def close_socket(self, socket_id=None):
+        self.close()
+
+    # Stop this device's background tasks (circuit probe, queued Sets), and its private transport if it has one
+    def close(self):
+        for task in (self.probe_task, self.outbound_task):
+            if task is not None:
+                task.cancel()
+        for msg_type, payload, num_repeats, future in self.outbound.values():
+            future.cancel()  # never to be sent
+        self.outbound.clear()
+        if self.owns_transport:
+            self.transport.close()
+
+    async def refresh(self, concurrent=True):
+        if concurrent:
+            await self.refresh_concurrent()
+            return
         self.label = await self.get_label()
         self.location = await self.get_location()
         self.group = await self.get_group()
@@ -25,9 +102,26 @@ class AsyncDevice(lifxlan.Device):
         self.product_name = await self.get_product_name()
         self.product_features = await self.get_product_features()
 
-    async def get_label(self):
+    async def refresh_concurrent(self):
+        """ Issue every Get of refresh() at once over the shared endpoint and gather the results """
+        (self.label, self.location, self.group, self.power_level,
+         (self.host_firmware_build_timestamp, self.host_firmware_version),
+         (self.wifi_firmware_build_timestamp, self.wifi_firmware_version),
+         (self.vendor, self.product, self.version)) = await asyncio.gather(
+            self.get_label(),
+            self.get_location(),
+            self.get_group(),
+            self.get_power(),
+            self.get_host_firmware_tuple(),
+            self.get_wifi_firmware_tuple(),
+            self.get_version_tuple())
+        # product name and features are looked up from the version, no need to ask the device again
+        self.product_name = await self.get_product_name()
+        self.product_features = await self.get_product_features()
+
+    async def get_label(self, max_age=None):
         try:
-            response = await self.req_with_resp(GetLabel, StateLabel)
+            response = await self.req_with_cached_resp(GetLabel, StateLabel, max_age)
             self.label = response.label.encode('utf-8')
             if type(self.label).__name__ == 'bytes': # Python 3
                 self.label = self.label.decode('utf-8')
@@ -35,9 +129,9 @@ class AsyncDevice(lifxlan.Device):
             raise
         return self.label
 
-    async def get_location(self):
+    async def get_location(self, max_age=None):
         try:
-            response = await self.req_with_resp(GetLocation, StateLocation)
+            response = await self.req_with_cached_resp(GetLocation, StateLocation, max_age)
             self.location = response.label.encode('utf-8')
             if type(self.location).__name__ == 'bytes': # Python 3
                 self.location = self.location.decode('utf-8')
@@ -45,9 +139,9 @@ class AsyncDevice(lifxlan.Device):
             raise
         return self.location
 
-    async def get_group(self):
+    async def get_group(self, max_age=None):
         try:
-            response = await self.req_with_resp(GetGroup, StateGroup)
+            response = await self.req_with_cached_resp(GetGroup, StateGroup, max_age)
             self.group = response.label.encode('utf-8')
             if type(self.group).__name__ == 'bytes': # Python 3
                 self.group = self.group.decode('utf-8')
@@ -60,9 +154,9 @@ class AsyncDevice(lifxlan.Device):
             label = label[:32]
         await self.req_with_ack(SetLabel, {"label": label})
 
-    async def get_power(self):
+    async def get_power(self, max_age=None):
         try:
-            response = await self.req_with_resp(GetPower, StatePower)
+            response = await self.req_with_cached_resp(GetPower, StatePower, max_age)
             self.power_level = response.power_level
         except:
             raise
@@ -84,31 +178,31 @@ class AsyncDevice(lifxlan.Device):
             success = False
         return success
 
-    async def get_host_firmware_tuple(self):
+    async def get_host_firmware_tuple(self, max_age=None):
         build = None
         version = None
         try:
-            response = await self.req_with_resp(GetHostFirmware, StateHostFirmware)
+            response = await self.req_with_cached_resp(GetHostFirmware, StateHostFirmware, max_age)
             build = response.build
             version = float(str(str(response.version >> 16) + "." + str(response.version & 0xff)))
         except:
             raise
         return build, version
 
-    async def get_host_firmware_build_timestamp(self):
-        self.host_firmware_build_timestamp, self.host_firmware_version = await self.get_host_firmware_tuple()
+    async def get_host_firmware_build_timestamp(self, max_age=None):
+        self.host_firmware_build_timestamp, self.host_firmware_version = await self.get_host_firmware_tuple(max_age)
         return self.host_firmware_build_timestamp
 
-    async def get_host_firmware_version(self):
-        self.host_firmware_build_timestamp, self.host_firmware_version = await self.get_host_firmware_tuple()
+    async def get_host_firmware_version(self, max_age=None):
+        self.host_firmware_build_timestamp, self.host_firmware_version = await self.get_host_firmware_tuple(max_age)
         return self.host_firmware_version
 
-    async def get_wifi_info_tuple(self):
+    async def get_wifi_info_tuple(self, max_age=None):
         signal = None
         tx = None
         rx = None
         try:
-            response = await self.req_with_resp(GetWifiInfo, StateWifiInfo)
+            response = await self.req_with_cached_resp(GetWifiInfo, StateWifiInfo, max_age)
             signal = response.signal
             tx = response.tx
             rx = response.rx
@@ -116,43 +210,43 @@ class AsyncDevice(lifxlan.Device):
             raise
         return signal, tx, rx
 
-    async def get_wifi_signal_mw(self):
-        signal, tx, rx = await self.get_wifi_info_tuple()
+    async def get_wifi_signal_mw(self, max_age=None):
+        signal, tx, rx = await self.get_wifi_info_tuple(max_age)
         return signal
 
-    async def get_wifi_tx_bytes(self):
-        signal, tx, rx = await self.get_wifi_info_tuple()
+    async def get_wifi_tx_bytes(self, max_age=None):
+        signal, tx, rx = await self.get_wifi_info_tuple(max_age)
         return tx
 
-    async def get_wifi_rx_bytes(self):
-        signal, tx, rx = await self.get_wifi_info_tuple()
+    async def get_wifi_rx_bytes(self, max_age=None):
+        signal, tx, rx = await self.get_wifi_info_tuple(max_age)
         return rx
 
-    async def get_wifi_firmware_tuple(self):
+    async def get_wifi_firmware_tuple(self, max_age=None):
         build = None
         version = None
         try:
-            response = await self.req_with_resp(GetWifiFirmware, StateWifiFirmware)
+            response = await self.req_with_cached_resp(GetWifiFirmware, StateWifiFirmware, max_age)
             build = response.build
             version = float(str(str(response.version >> 16) + "." + str(response.version & 0xff)))
         except:
             raise
         return build, version
 
-    async def get_wifi_firmware_build_timestamp(self):
-        self.wifi_firmware_build_timestamp, self.wifi_firmware_version = await self.get_wifi_firmware_tuple()
+    async def get_wifi_firmware_build_timestamp(self, max_age=None):
+        self.wifi_firmware_build_timestamp, self.wifi_firmware_version = await self.get_wifi_firmware_tuple(max_age)
         return self.wifi_firmware_build_timestamp
 
-    async def get_wifi_firmware_version(self):
-        self.wifi_firmware_build_timestamp, self.wifi_firmware_version = await self.get_wifi_firmware_tuple()
+    async def get_wifi_firmware_version(self, max_age=None):
+        self.wifi_firmware_build_timestamp, self.wifi_firmware_version = await self.get_wifi_firmware_tuple(max_age)
         return self.wifi_firmware_version
 
-    async def get_version_tuple(self):
+    async def get_version_tuple(self, max_age=None):
         vendor = None
         product = None
         version = None
         try:
-            response = await self.req_with_resp(GetVersion, StateVersion)
+            response = await self.req_with_cached_resp(GetVersion, StateVersion, max_age)
             vendor = response.vendor
             product = response.product
             version = response.version
@@ -176,23 +270,23 @@ class AsyncDevice(lifxlan.Device):
             product_features = features_map[self.product]
         return product_features
 
-    async def get_vendor(self):
-        self.vendor, self.product, self.version = await self.get_version_tuple()
+    async def get_vendor(self, max_age=None):
+        self.vendor, self.product, self.version = await self.get_version_tuple(max_age)
         return self.vendor
 
-    async def get_product(self):
-        self.vendor, self.product, self.version = await self.get_version_tuple()
+    async def get_product(self, max_age=None):
+        self.vendor, self.product, self.version = await self.get_version_tuple(max_age)
         return self.product
 
-    async def get_version(self):
-        self.vendor, self.product, self.version = await self.get_version_tuple()
+    async def get_version(self, max_age=None):
+        self.vendor, self.product, self.version = await self.get_version_tuple(max_age)
         return self.version
 
-    async def get_location_tuple(self):
+    async def get_location_tuple(self, max_age=None):
         label = None
         updated_at = None
         try:
-            response = await self.req_with_resp(GetLocation, StateLocation)
+            response = await self.req_with_cached_resp(GetLocation, StateLocation, max_age)
             self.location = response.location
             label = response.label
             updated_at = response.updated_at
@@ -200,17 +294,17 @@ class AsyncDevice(lifxlan.Device):
             raise
         return self.location, label, updated_at
 
-    async def get_location_label(self):
-        self.location, label, updated_at = await self.get_location_tuple()
+    async def get_location_label(self, max_age=None):
+        self.location, label, updated_at = await self.get_location_tuple(max_age)
         return label
 
-    async def get_location_updated_at(self):
-        self.location, label, updated_at = await self.get_location_tuple()
+    async def get_location_updated_at(self, max_age=None):
+        self.location, label, updated_at = await self.get_location_tuple(max_age)
         return updated_at
 
-    async def get_group_tuple(self):
+    async def get_group_tuple(self, max_age=None):
         try:
-            response = await self.req_with_resp(GetGroup, StateGroup)
+            response = await self.req_with_cached_resp(GetGroup, StateGroup, max_age)
             self.group = response.group
             label = response.label
             updated_at = response.updated_at
@@ -218,20 +312,20 @@ class AsyncDevice(lifxlan.Device):
             raise
         return self.group, label, updated_at
 
-    async def get_group_label(self):
-        self.group, label, updated_at = await self.get_group_tuple()
+    async def get_group_label(self, max_age=None):
+        self.group, label, updated_at = await self.get_group_tuple(max_age)
         return label
 
-    async def get_group_updated_at(self):
-        self.group, label, updated_at = await self.get_group_tuple()
+    async def get_group_updated_at(self, max_age=None):
+        self.group, label, updated_at = await self.get_group_tuple(max_age)
         return updated_at
 
-    async def get_info_tuple(self):
+    async def get_info_tuple(self, max_age=None):
         time = None
         uptime = None
         downtime = None
         try:
-            response = await self.req_with_resp(GetInfo, StateInfo)
+            response = await self.req_with_cached_resp(GetInfo, StateInfo, max_age)
             time = response.time
             uptime = response.uptime
             downtime = response.downtime
@@ -239,16 +333,16 @@ class AsyncDevice(lifxlan.Device):
             raise
         return time, uptime, downtime
 
-    async def get_time(self):
-        time, uptime, downtime = await self.get_info_tuple()
+    async def get_time(self, max_age=None):
+        time, uptime, downtime = await self.get_info_tuple(max_age)
         return time
 
-    async def get_uptime(self):
-        time, uptime, downtime = await self.get_info_tuple()
+    async def get_uptime(self, max_age=None):
+        time, uptime, downtime = await self.get_info_tuple(max_age)
         return uptime
 
-    async def get_downtime(self):
-        time, uptime, downtime = await self.get_info_tuple()
+    async def get_downtime(self, max_age=None):
+        time, uptime, downtime = await self.get_info_tuple(max_age)
         return downtime
 
     async def is_light(self):
@@ -281,6 +375,21 @@ class AsyncDevice(lifxlan.Device):
             self.product_features = await self.get_product_features()
         return self.product_features['chain']
 
+    async def is_switch(self):
+        if self.product == None:
+            self.vendor, self.product, self.version = await self.get_version_tuple()
+        return self.product in switch_products
+
+    async def device_time_str(self, indent):
+        time, uptime, downtime = await self.get_info_tuple()
+        time_s = datetime.utcfromtimestamp(time/1000000000) if time != None else None
+        uptime_s = round(nanosec_to_hours(uptime), 2) if uptime != None else None
+        downtime_s = round(nanosec_to_hours(downtime), 2) if downtime != None else None
+        s = "Current Time: {} ({} UTC)\n".format(time, time_s)
+        s += indent + "Uptime (ns): {} ({} hours)\n".format(uptime, uptime_s)
+        s += indent + "Last Downtime Duration +/-5s (ns): {} ({} hours)\n".format(downtime, downtime_s)
+        return s
+
     async def device_radio_str(self, indent):
         signal, tx, rx = await self.get_wifi_info_tuple()
         s = "Wifi Signal Strength (mW): {}\n".format(signal)
@@ -288,114 +397,274 @@ class AsyncDevice(lifxlan.Device):
         s += indent + "Wifi RX (bytes): {}\n".format(rx)
         return s
 
+    def __repr__(self):
+        # lifxlan's __repr__ queries the device; repr can't await, so report the cached attributes
+        return '<{cls}: {label!r} ({mac_addr})>'.format(
+            cls=self.__class__.__name__,
+            label=self.label,
+            mac_addr=self.mac_addr)
+
+    # lifxlan's __str__ refreshes the device first; str can't await, so it describes what is already known.
+    # await device_str() for the full, freshly queried description.
     def __str__(self):
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.refresh())
         indent = "  "
         s = self.device_characteristics_str(indent)
         s += indent + self.device_firmware_str(indent)
         s += indent + self.device_product_str(indent)
-        s += indent + self.device_time_str(indent)
-        s += indent + loop.run_until_complete(self.device_radio_str(indent))
         return s
 
+    async def device_str(self):
+        await self.refresh()
+        indent = "  "
+        s = str(self)
+        s += indent + await self.device_time_str(indent)
+        s += indent + await self.device_radio_str(indent)
+        return s
+
+    # Serve a Get from the state cache if its response is recent enough, otherwise ask the device
+    async def req_with_cached_resp(self, msg_type, response_type, max_age=None):
+        response = self.cache.get(response_type, max_age)
+        if response is MISSING:
+            response = await self.req_with_resp(msg_type, response_type)
+            self.cache.put(response)
+        return response
+
     # Don't wait for Acks or Responses, just send the same message repeatedly as fast as possible
     async def fire_and_forget(self, msg_type, payload={}, timeout_secs=DEFAULT_TIMEOUT, num_repeats=DEFAULT_ATTEMPTS):
-        socket_id = self.initialize_socket(timeout_secs)
-        sock = self.socket_table[socket_id]
-        msg = msg_type(self.mac_addr, self.source_id, seq_num=0, payload=payload, ack_requested=False, response_requested=False)
+        if msg_type in COALESCED_STATES:
+            await self.enqueue(msg_type, payload, num_repeats)
+            return
+        transport = await self.get_transport()
+        seq_num = transport.next_seq_num(self.mac_addr)
+        msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=False, response_requested=False)
         sent_msg_count = 0
-        sleep_interval = 0.05 if num_repeats > 20 else 0
         while(sent_msg_count < num_repeats):
-            if self.ip_addr:
-                sock.sendto(msg.packed_message, (self.ip_addr, self.port))
-            else:
-                for ip_addr in UDP_BROADCAST_IP_ADDRS:
-                    sock.sendto(msg.packed_message, (ip_addr, self.port))
-            if self.verbose:
-                print("SEND: " + str(msg))
+            await self.send(transport, msg)  # paced by the transport's per-device rate limit
             sent_msg_count += 1
-            await asyncio.sleep(sleep_interval)  # Max num of messages device can handle is 20 per second.
-        await self.close_socket(socket_id)
+        # no ack to confirm it, but a Set that may have landed makes the cached state untrustworthy
+        self.cache.invalidate(msg_type)
+
+    async def enqueue(self, msg_type, payload, num_repeats):
+        """ Queue a Set for sending, replacing any still-pending Set of the same state (latest wins)
+
+        The replaced Set's place in the queue is kept, so a Set of another state
+        queued before it still goes out first. Returns once the message has been
+        sent or superseded by a newer one.
+        """
+        payload = pack_payload(msg_type, payload)  # a bad payload fails here, for its caller, not in the drain task
+        future = asyncio.get_running_loop().create_future()
+        state = COALESCED_STATES[msg_type]
+        pending = self.outbound.get(state)
+        if pending is not None:
+            pending[0], pending[1], pending[2] = msg_type, payload, num_repeats
+            if not pending[3].done():  # done already if its caller was cancelled
+                pending[3].set_result(None)  # superseded
+            pending[3] = future
+        else:
+            self.outbound[state] = [msg_type, payload, num_repeats, future]
+        if not is_running(self.outbound_task):
+            self.outbound_task = asyncio.ensure_future(self.drain_outbound())
+        await future
+
+    async def drain_outbound(self):
+        future = None  # of the Set being sent, no longer in self.outbound
+        try:
+            transport = await self.get_transport()
+            while self.outbound:
+                # wait for a slot before picking the message, so whatever is newest by then goes out
+                await transport.scheduler.acquire(self.mac_addr)
+                state = next(iter(self.outbound))
+                msg_type, payload, num_repeats, future = self.outbound.pop(state)
+                msg = self.packet_template.encode_packed(msg_type, transport.next_seq_num(self.mac_addr), payload, ack_requested=False, response_requested=False)
+                for addr in self.addrs():
+                    transport.sendto_nowait(msg, addr)
+                self.cache.invalidate(msg_type)
+                if num_repeats > 1:
+                    self.outbound[state] = [msg_type, payload, num_repeats - 1, future]  # repeat at the back of the queue
+                elif not future.done():
+                    future.set_result(None)
+                future = None
+        except Exception as e:
+            futures = [future] + [pending[3] for pending in self.outbound.values()]
+            self.outbound.clear()
+            for future in futures:
+                if future is not None and not future.done():
+                    future.set_exception(e)  # their callers get the error, the task ends quietly
 
     # Usually used for Set messages
-    async def req_with_ack(self, msg_type, payload, timeout_secs=DEFAULT_TIMEOUT, max_attempts=DEFAULT_ATTEMPTS):
+    async def req_with_ack(self, msg_type, payload, timeout_secs=None, max_attempts=None):
         await self.req_with_resp(msg_type, Acknowledgement, payload, timeout_secs, max_attempts)
 
+    # Per-attempt timeouts: fixed if the caller gives either, otherwise adapted to this device's measured RTT
+    def retransmit_timeouts(self, timeout_secs=None, max_attempts=None):
+        if timeout_secs is None and max_attempts is None:
+            return self.rtt.timeouts()
+        if timeout_secs is None:
+            timeout_secs = DEFAULT_TIMEOUT
+        if max_attempts is None:
+            max_attempts = DEFAULT_ATTEMPTS
+        return [timeout_secs] * max_attempts
+
     # Usually used for Get messages, or for state confirmation after Set (hence the optional payload)
-    async def req_with_resp(self, msg_type, response_type, payload={}, timeout_secs=DEFAULT_TIMEOUT, max_attempts=DEFAULT_ATTEMPTS):
+    async def req_with_resp(self, msg_type, response_type, payload={}, timeout_secs=None, max_attempts=None):
         # Need to put error checking here for aguments
         if type(response_type) != type([]):
             response_type = [response_type]
-        success = False
         device_response = None
-        socket_id = self.initialize_socket(timeout_secs)
-        sock = self.socket_table[socket_id]
+        rtt = None
+        self.check_circuit()
+        transport = await self.get_transport()
+        seq_num = await transport.acquire_seq_num(self.mac_addr)
         if len(response_type) == 1 and Acknowledgement in response_type:
-            msg = msg_type(self.mac_addr, self.source_id, seq_num=0, payload=payload, ack_requested=True, response_requested=False)
+            msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=True, response_requested=False)
         else:
-            msg = msg_type(self.mac_addr, self.source_id, seq_num=0, payload=payload, ack_requested=False, response_requested=True)
-        response_seen = False
-        attempts = 0
-        while not response_seen and attempts < max_attempts:
-            sent = False
-            start_time = time()
-            timedout = False
-            while not response_seen and not timedout:
-                if not sent:
-                    if self.ip_addr:
-                        sock.sendto(msg.packed_message, (self.ip_addr, self.port))
-                    else:
-                        for ip_addr in UDP_BROADCAST_IP_ADDRS:
-                            sock.sendto(msg.packed_message, (ip_addr, self.port))
-                    sent = True
-                    if self.verbose:
-                        print("SEND: " + str(msg))
-                try:
-                    data, (ip_addr, port) = sock.recvfrom(1024)
-                    response = unpack_lifx_message(data)
-                    if self.verbose:
-                        print("RECV: " + str(response))
+            msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=False, response_requested=True)
+        loop = asyncio.get_running_loop()
+        with transport.subscribe(self.mac_addr, seq_num, self.source_id) as subscription:
+            for attempt, timeout in enumerate(self.retransmit_timeouts(timeout_secs, max_attempts)):
+                await self.send(transport, msg)
+                sent_at = loop.time()
+                if attempt == 0:
+                    first_sent_at = sent_at
+                deadline = sent_at + timeout
+                while device_response is None:
+                    try:
+                        response, (ip_addr, port) = await subscription.recv(deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
                     if type(response) in response_type:
-                        if response.source_id == self.source_id and (response.target_addr == self.mac_addr or response.target_addr == BROADCAST_MAC):
-                            response_seen = True
-                            device_response = response
-                            self.ip_addr = ip_addr
-                            success = True
-                except timeout:
-                    pass
-                elapsed_time = time() - start_time
-                timedout = True if elapsed_time > timeout_secs else False
-            attempts += 1
-        if not success:
-            await self.close_socket(socket_id)
+                        device_response = response
+                        self.ip_addr = ip_addr
+                        if attempt == 0:  # a reply after a retransmit can't be attributed to either send
+                            self.rtt.update(loop.time() - sent_at)
+                if device_response is not None:
+                    rtt = loop.time() - first_sent_at
+                    break
+        self.record_result(msg_type, rtt, attempt + 1)
+        if device_response is None:
             raise WorkflowException("WorkflowException: Did not receive {} from {} (Name: {}) in response to {}".format(str(response_type), str(self.mac_addr), str(self.label), str(msg_type)))
-        else:
-            await self.close_socket(socket_id)
+        self.cache.invalidate(msg_type)
+        return device_response
+
+    # Fail fast while the circuit is open, except for the request that serves as the next probe
+    def check_circuit(self):
+        if not self.breaker.allow():
+            raise CircuitOpenException("CircuitOpenException: {} (Name: {}) is not responding, waiting for it to answer a probe".format(str(self.mac_addr), str(self.label)))
+
+    # Outcome of one request: rtt is the time from its first send to the answer, None if it never came
+    def record_result(self, msg_type, rtt, attempts):
+        self.transport.metrics.record_request(self.mac_addr, msg_type, rtt, attempts)
+        if rtt is not None:
+            self.breaker.record_success()
+        elif self.breaker.record_failure() and not is_running(self.probe_task):
+            self.probe_task = asyncio.ensure_future(self.probe())
+
+    async def probe(self):
+        """ Ask for the power level once per probe interval until the device answers and the circuit closes
+
+        Each probe is a single packet with a single timeout: the device is probably
+        gone, and the next probe interval is the retry.
+        """
+        while self.breaker.is_open:
+            await asyncio.sleep(self.breaker.probe_delay())
+            try:
+                await self.req_with_resp(GetPower, StatePower, timeout_secs=DEFAULT_TIMEOUT, max_attempts=1)
+            except WorkflowException:
+                pass
+
+    def addrs(self):
+        if self.ip_addr:
+            return [(self.ip_addr, self.port)]
+        if self.interface is not None:  # only its own subnet can reach it
+            return [(self.interface.broadcast_addr, self.port)]
+        return [(ip_addr, self.port) for ip_addr in self.broadcast_addrs or []]
+
+    async def send(self, transport, msg):
+        for addr in self.addrs():
+            await transport.sendto(msg, addr)
+
+    # Usually used for Set messages that need confirming: one message asks for both the ack and the resulting state
+    async def req_with_ack_resp(self, msg_type, response_type, payload, timeout_secs=None, max_attempts=None):
+        acked = False
+        device_response = None
+        rtt = None
+        self.check_circuit()
+        transport = await self.get_transport()
+        seq_num = await transport.acquire_seq_num(self.mac_addr)
+        msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=True, response_requested=True)
+        loop = asyncio.get_running_loop()
+        with transport.subscribe(self.mac_addr, seq_num, self.source_id) as subscription:
+            for attempt, timeout in enumerate(self.retransmit_timeouts(timeout_secs, max_attempts)):
+                await self.send(transport, msg)
+                sent_at = loop.time()
+                if attempt == 0:
+                    first_sent_at = sent_at
+                deadline = sent_at + timeout
+                while not acked or device_response is None:
+                    try:
+                        response, (ip_addr, port) = await subscription.recv(deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                    if type(response) == Acknowledgement:
+                        acked = True
+                        if attempt == 0 and device_response is None:
+                            self.rtt.update(loop.time() - sent_at)
+                    elif type(response) == response_type:
+                        device_response = response
+                    self.ip_addr = ip_addr
+                if acked and device_response is not None:
+                    rtt = loop.time() - first_sent_at
+                    break
+        self.record_result(msg_type, rtt, attempt + 1)
+        if not acked or device_response is None:
+            raise WorkflowException("WorkflowException: Did not receive {} from {} (Name: {}) in response to {}".format(str([Acknowledgement, response_type]), str(self.mac_addr), str(self.label), str(msg_type)))
+        self.cache.invalidate(msg_type)
+        self.cache.put(device_response)  # the state after the Set, straight from the device
         return device_response
 
-        # Not currently implemented, although the LIFX LAN protocol supports this kind of workflow natively
-    async def req_with_ack_resp(self, msg_type, response_type, payload, timeout_secs=DEFAULT_TIMEOUT, max_attempts=DEFAULT_ATTEMPTS):
-        pass
+    # For Gets answered by several packets, e.g. MultiZoneGetExtendedColorZones: collects responses until
+    # their index/cCount fields cover all count zones, and returns them in index order
+    async def req_with_multiple_resp(self, msg_type, response_type, payload={}, timeout_secs=None, max_attempts=None):
+        if type(response_type) != type([]):
+            response_type = [response_type]
+        responses = {}  # index -> response; a retransmit's duplicates just overwrite
+        covered = 0
+        total = None
+        self.check_circuit()
+        transport = await self.get_transport()
+        seq_num = await transport.acquire_seq_num(self.mac_addr)
+        msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=False, response_requested=True)
+        loop = asyncio.get_running_loop()
+        rtt = None
+        with transport.subscribe(self.mac_addr, seq_num, self.source_id) as subscription:
+            for attempt, timeout in enumerate(self.retransmit_timeouts(timeout_secs, max_attempts)):
+                await self.send(transport, msg)
+                sent_at = loop.time()
+                if attempt == 0:
+                    first_sent_at = sent_at
+                deadline = sent_at + timeout
+                while total is None or covered < total:
+                    try:
+                        response, (ip_addr, port) = await subscription.recv(deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                    if type(response) not in response_type:
+                        continue
+                    if not (hasattr(response, 'index') and hasattr(response, 'count') and hasattr(response, 'cCount')):
+                        raise WorkflowException("WorkflowException: Response type {} does not have expected attributes for req_with_multiple_resp".format(type(response)))
+                    self.ip_addr = ip_addr
+                    if response.index not in responses:
+                        covered += response.cCount
+                    responses[response.index] = response
+                    total = response.count
+                if total is not None and covered >= total:
+                    rtt = loop.time() - first_sent_at
+                    break
+        self.record_result(msg_type, rtt, attempt + 1)
+        if rtt is None:
+            raise WorkflowException("WorkflowException: Did not receive complete {} response from {} (Name: {}) in response to {}".format(str(response_type), str(self.mac_addr), str(self.label), str(msg_type)))
+        return [responses[index] for index in sorted(responses)]
 
-    async def initialize_socket(self, timeout):
-        sock = socket(AF_INET, SOCK_DGRAM)
-        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        sock.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-        sock.settimeout(timeout)
-        try:
-            sock.bind(("", 0))  # allow OS to assign next available source port
-            socket_id = self.socket_counter
-            self.socket_table[socket_id] = sock
-            self.socket_counter += 1
-            return socket_id
-        except Exception as err:
-            raise WorkflowException("WorkflowException: error {} while trying to open socket".format(str(err)))
-
-    async def close_socket(self, socket_id):
-        sock = self.socket_table.pop(socket_id, None)
-        if sock != None:
-            sock.close()
 
 def nanosec_to_hours(ns):
     return ns/(1000000000.0*60*60)
\ No newline at end of file
@@ -0,0 +1,57 @@
+import asyncio
+from collections import namedtuple
+
+from lifxlan.msgtypes import LightState, LightStatePower, StatePower
+
+# State packets the tracker folds into the device model
+TRACKED_MSG_TYPES = [StatePower, LightStatePower, LightState]
+DEFAULT_EVENT_BACKLOG = 1024  # events kept per subscriber before the oldest are dropped
+
+# A tracked attribute of a known device changed: previous is None the first time it is seen
+StateEvent = namedtuple("StateEvent", ["device", "field", "value", "previous"])
+
+
+class StateTracker:
+    """ Keeps known devices' power and color current from every State packet that reaches the transport
+
+    That includes replies to other clients' broadcasts and late replies to our
+    own retransmits, not just responses to requests in flight. Each change is
+    published as a StateEvent to every events() iterator.
+    """
+    def __init__(self, registry, backlog=DEFAULT_EVENT_BACKLOG):
+        self.registry = registry
+        self.backlog = backlog
+        self.queues = set()
+
+    def observe(self, response, addr):
+        """ Transport observer: update the device and publish what changed """
+        device = self.registry.get_by_mac(response.target_addr)
+        if device is None:
+            return
+        device.cache.put(response)
+        self.set(device, "power_level", response.power_level)
+        if type(response) == LightState:
+            self.set(device, "color", tuple(response.color))
+
+    def set(self, device, field, value):
+        previous = getattr(device, field, None)
+        if isinstance(previous, list):  # colors set elsewhere may be lists
+            previous = tuple(previous)
+        if previous != value:
+            setattr(device, field, value)
+            self.publish(StateEvent(device, field, value, previous))
+
+    def publish(self, event):
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()  # a slow subscriber loses the oldest events, not the newest
+            queue.put_nowait(event)
+
+    async def events(self):
+        queue = asyncio.Queue(self.backlog)
+        self.queues.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.queues.discard(queue)
@@ -0,0 +1,179 @@
+import asyncio
+
+from lifxlan.errors import InvalidParameterException
+from lifxlan.group import Group
+from lifxlan.msgtypes import LightGet, LightSetInfrared, LightState
+
+from lifxlan_asyncio.light import Light, MultiZoneLight
+
+
+class Scene:
+    """ Snapshot of the color and power level of some lights, keyed by MAC so it outlives rediscovery """
+    def __init__(self, colors=None, power_levels=None):
+        self.colors = dict(colors or {})              # mac -> (hue, saturation, brightness, kelvin)
+        self.power_levels = dict(power_levels or {})  # mac -> power level
+
+    def __len__(self):
+        return len(self.colors)
+
+    def as_dict(self):
+        """ JSON-friendly form, see from_dict """
+        return {mac_addr: {"color": list(color), "power_level": self.power_levels.get(mac_addr)}
+                for mac_addr, color in self.colors.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls({mac_addr: tuple(d["color"]) for mac_addr, d in data.items()},
+                   {mac_addr: d["power_level"] for mac_addr, d in data.items() if d.get("power_level") is not None})
+
+    def __repr__(self):
+        return "<Scene: {} lights>".format(len(self))
+
+
+class AsyncGroup(Group):
+    """ lifxlan Group whose operations are coroutines fanning out over the client's shared transport
+
+    Instead of a thread per device, Sets go out as one batched unicast of
+    the owning AsyncLifxLAN (every device's message sent, then every ack
+    collected against one deadline), and colors are read with one broadcast
+    LightGet. Sets return a dict of device: exception for the devices that
+    did not confirm, like AsyncLifxLAN.set_colors.
+    """
+    def __init__(self, lan, devices=None, verbose=False):
+        super().__init__(list(devices or []), verbose)
+        self.lan = lan
+
+    def remove_device_by_name(self, device_name):
+        self.devices = [d for d in self.devices if d.label != device_name]
+
+    def lights(self):
+        return [d for d in self.devices if isinstance(d, Light)]
+
+    async def set_power(self, power, duration=0, rapid=False):
+        failures = await self.lan.set_powers({light: power for light in self.lights()}, duration, rapid)
+        others = [d for d in self.devices if not isinstance(d, Light)]
+        results = await asyncio.gather(*(self.set_power_helper(d, power, duration, rapid) for d in others), return_exceptions=True)
+        failures.update((d, e) for d, e in zip(others, results) if isinstance(e, Exception))
+        return failures
+
+    # Set the power of one device of the group, raising if it does not confirm
+    async def set_power_helper(self, device, power, duration, rapid):
+        if isinstance(device, Light):
+            failures = await self.lan.set_powers({device: power}, duration, rapid)
+            if device in failures:
+                raise failures[device]
+        else:
+            await device.set_power(power, rapid)  # only lights fade
+
+    async def get_power(self):
+        """ dict of device: power level, for the devices that answered """
+        results = await asyncio.gather(*(d.get_power() for d in self.devices), return_exceptions=True)
+        return {d: power_level for d, power_level in zip(self.devices, results) if not isinstance(power_level, Exception)}
+
+    async def get_light_states(self):
+        """ LightState of every light in the group, asked for with one broadcast LightGet
+
+        Lights that don't answer the broadcast are asked once more directly; the
+        ones that still don't answer are left out.
+        """
+        members = {light.mac_addr: light for light in self.lights()}
+        states = {}
+        if members:
+            responses = self.lan.iter_lights_with_resp(LightGet, LightState)
+            try:
+                async for light, response in responses:
+                    if light.mac_addr in members:
+                        states[light.mac_addr] = response
+                        if len(states) == len(members):
+                            break  # no need to wait out the timeout for lights outside the group
+            finally:
+                await responses.aclose()
+        missing = [light for mac_addr, light in members.items() if mac_addr not in states]
+        results = await asyncio.gather(*(light.req_with_resp(LightGet, LightState) for light in missing), return_exceptions=True)
+        for light, response in zip(missing, results):
+            if not isinstance(response, Exception):
+                light.cache.put(response)
+                states[light.mac_addr] = response
+        return {members[mac_addr]: response for mac_addr, response in states.items()}
+
+    async def get_color(self):
+        """ dict of light: color, for the lights that answered """
+        return {light: response.color for light, response in (await self.get_light_states()).items()}
+
+    async def set_color(self, color, duration=0, rapid=False):
+        lights = [light for light in self.lights() if await light.supports_color()]
+        return await self.lan.set_colors({light: color for light in lights}, duration, rapid)
+
+    # Hue, saturation, brightness and kelvin change one component of each light's own color,
+    # so all current colors are read up front and then set in one batch
+    async def set_color_component(self, index, value, duration=0, rapid=False):
+        colors = {}
+        for light, color in (await self.get_color()).items():
+            if await light.supports_color():
+                color = list(color)
+                color[index] = value
+                colors[light] = color
+        return await self.lan.set_colors(colors, duration, rapid)
+
+    async def set_hue(self, hue, duration=0, rapid=False):
+        return await self.set_color_component(0, hue, duration, rapid)
+
+    async def set_saturation(self, saturation, duration=0, rapid=False):
+        return await self.set_color_component(1, saturation, duration, rapid)
+
+    async def set_brightness(self, brightness, duration=0, rapid=False):
+        return await self.set_color_component(2, brightness, duration, rapid)
+
+    async def set_colortemp(self, kelvin, duration=0, rapid=False):
+        return await self.set_color_component(3, kelvin, duration, rapid)
+
+    async def set_infrared(self, infrared_brightness, rapid=False):
+        lights = [light for light in self.lights() if await light.supports_infrared()]
+        return await self.lan.unicast(LightSetInfrared, {light: {"infrared_brightness": infrared_brightness} for light in lights}, rapid)
+
+    async def set_zone_colors(self, colors, duration=0, rapid=False, *, index=0, apply=1):
+        lights = [light for light in self.lights() if isinstance(light, MultiZoneLight)]
+        results = await asyncio.gather(*(light.set_zone_colors(colors, duration, rapid, index=index, apply=apply) for light in lights),
+                                       return_exceptions=True)
+        return {light: e for light, e in zip(lights, results) if isinstance(e, Exception)}
+
+    # Zones start to end (inclusive) of every strip in the group to one color, sent like set_zone_colors
+    async def set_zone_color(self, start, end, color, duration=0, rapid=False, apply=1):
+        if len(color) != 4:
+            raise InvalidParameterException("{} is not a valid color.".format(color))
+        return await self.set_zone_colors([color] * (end - start + 1), duration, rapid, index=start, apply=apply)
+
+    async def capture_scene(self):
+        """ Scene of the current color and power level of every light that answers one broadcast LightGet """
+        states = await self.get_light_states()
+        return Scene({light.mac_addr: tuple(response.color) for light, response in states.items()},
+                     {light.mac_addr: response.power_level for light, response in states.items()})
+
+    async def apply_scene(self, scene, duration=0, rapid=False):
+        """ Set every light of the group that is in scene back to its color and power level
+
+        Colors and power levels go out as two concurrent batches, colors first, so
+        the whole scene changes in about one round trip whatever the group size.
+        """
+        colors = {}
+        power_levels = {}
+        for light in self.lights():
+            if light.mac_addr in scene.colors:
+                colors[light] = scene.colors[light.mac_addr]
+            if light.mac_addr in scene.power_levels:
+                power_levels[light] = scene.power_levels[light.mac_addr]
+        for color in colors.values():
+            if len(color) != 4:
+                raise InvalidParameterException("{} is not a valid color.".format(color))
+        color_failures, power_failures = await asyncio.gather(
+            self.lan.set_colors(colors, duration, rapid),
+            self.lan.set_powers(power_levels, duration, rapid))
+        failures = dict(power_failures)
+        failures.update(color_failures)
+        return failures
+
+    def __str__(self):
+        s = "AsyncGroup ({}):\n\n".format(len(self.devices))
+        for d in self.devices:
+            s += str(d) + "\n"
+        return s
@@ -0,0 +1,101 @@
+import asyncio
+import random
+from time import time
+
+from lifxlan.errors import WorkflowException
+
+DEFAULT_POLL_INTERVAL = 30  # seconds between polls of a healthy device
+DEFAULT_JITTER = 0.5        # how far a poll may stray from its slot, as a fraction of the slot
+MAX_BACKOFF = 16            # an offline device is polled at least every MAX_BACKOFF intervals
+
+
+class DeviceHealth:
+    """ What the last polls found out about one device """
+    __slots__ = ("last_seen", "rtt", "signal_mw", "power_level", "uptime", "failures", "next_poll")
+
+    def __init__(self):
+        self.last_seen = None  # wall-clock time of the last successful poll
+        self.rtt = None        # smoothed round trip, seconds
+        self.signal_mw = None
+        self.power_level = None
+        self.uptime = None
+        self.failures = 0      # consecutive failed polls
+        self.next_poll = 0     # loop time before which a backed-off device is skipped
+
+    @property
+    def online(self):
+        return self.last_seen is not None and self.failures == 0
+
+    def __repr__(self):
+        return "<DeviceHealth: {}>".format(", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class HealthPoller:
+    """ Polls power, Wi-Fi signal and uptime of every registered device in the background
+
+    Each interval is cut into one slot per device and every device is polled in
+    its own (jittered) slot, so the network sees a steady trickle of requests
+    instead of a burst per interval. A device that fails to answer waits twice
+    as many intervals after each failure, up to MAX_BACKOFF, before it is tried again.
+    """
+    def __init__(self, registry, interval=DEFAULT_POLL_INTERVAL, jitter=DEFAULT_JITTER):
+        self.registry = registry
+        self.interval = interval
+        self.jitter = jitter
+        self.health = {}     # mac -> DeviceHealth
+        self.in_flight = {}  # mac -> poll task
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return self
+
+    def stop(self):
+        for task in [self.task] + list(self.in_flight.values()):
+            if task is not None:
+                task.cancel()
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            cycle_start = loop.time()
+            devices = self.registry.devices()
+            if devices:
+                slot = self.interval / len(devices)
+                for index, device in enumerate(devices):
+                    due = cycle_start + slot * (index + random.uniform(-self.jitter, self.jitter))
+                    await asyncio.sleep(max(0, due - loop.time()))
+                    self.schedule(device, loop.time())
+            await asyncio.sleep(max(0, cycle_start + self.interval - loop.time()))
+
+    def schedule(self, device, now):
+        """ Start polling device unless it is backed off or its previous poll is still running """
+        health = self.health.get(device.mac_addr)
+        if health is None:
+            health = self.health[device.mac_addr] = DeviceHealth()
+        if now < health.next_poll or device.mac_addr in self.in_flight:
+            return
+        task = asyncio.ensure_future(self.poll(device, health))
+        self.in_flight[device.mac_addr] = task
+        task.add_done_callback(lambda _: self.in_flight.pop(device.mac_addr, None))
+
+    async def poll(self, device, health):
+        loop = asyncio.get_running_loop()
+        try:
+            # the cheapest request goes first, so an offline device costs one timeout
+            power_level = await device.get_power(max_age=0)
+            (signal_mw, tx, rx), uptime = await asyncio.gather(device.get_wifi_info_tuple(max_age=0), device.get_uptime(max_age=0))
+        except WorkflowException:
+            health.failures += 1
+            backoff = min(MAX_BACKOFF, 2 ** health.failures)  # intervals until the next try
+            health.next_poll = loop.time() + self.interval * (backoff - 0.5)  # early by half of one, so jitter can't skip a cycle
+            return
+        health.last_seen = time()
+        health.rtt = device.rtt.srtt
+        health.signal_mw = signal_mw
+        health.power_level = power_level
+        health.uptime = uptime
+        health.failures = 0
+        health.next_poll = 0
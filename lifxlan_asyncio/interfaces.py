@@ -0,0 +1,50 @@
+import asyncio
+from collections import namedtuple
+from ipaddress import IPv4Address, IPv4Network
+
+import ifaddr
+
+from lifxlan_asyncio.async_helpers import run_async
+
+LIMITED_BROADCAST_ADDR = "255.255.255.255"  # when no interface has an IPv4 address to derive one from
+
+# One IPv4 address of a network interface; a NIC with several subnets has one per subnet
+Interface = namedtuple("Interface", ["name", "ip_addr", "network", "broadcast_addr"])
+
+
+def enumerate_interfaces():
+    """ Every non-loopback IPv4 interface address (blocking, see get_interfaces) """
+    interfaces = []
+    for adapter in ifaddr.get_adapters():
+        for addr in adapter.ips:
+            if not addr.is_IPv4 or IPv4Address(addr.ip).is_loopback:
+                continue
+            network = IPv4Network((addr.ip, addr.network_prefix), strict=False)
+            interfaces.append(Interface(adapter.nice_name, addr.ip, network, str(network.broadcast_address)))
+    return interfaces
+
+
+def find_interface(interfaces, ip_addr):
+    """ The interface whose subnet ip_addr (a host or the subnet's broadcast address) is on, else None """
+    try:
+        ip_addr = IPv4Address(ip_addr)
+    except ValueError:
+        return None
+    for interface in interfaces:
+        if ip_addr in interface.network:
+            return interface
+    return None
+
+
+async def get_interfaces():
+    return await run_async(asyncio.get_running_loop(), enumerate_interfaces)
+
+
+def broadcast_addrs(interfaces):
+    """ One directed broadcast address per subnet """
+    return list(dict.fromkeys(interface.broadcast_addr for interface in interfaces)) or [LIMITED_BROADCAST_ADDR]
+
+
+async def get_broadcast_addrs():
+    """ Directed broadcast address of every IPv4 interface, enumerated off the event loop """
+    return broadcast_addrs(await get_interfaces())
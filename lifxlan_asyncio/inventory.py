@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+
+from lifxlan.products import features_map
+
+INVENTORY_VERSION = 1  # bumped whenever the entry layout changes; other versions are ignored on load
+
+# device attributes saved as they are
+FIELDS = ["mac_addr", "ip_addr", "port", "service", "vendor", "product", "version", "product_features"]
+
+
+def device_entry(device, keys=None):
+    """ What needs saving of a device to control it without discovering it again
+
+    keys are the label/group/location the registry knows (the device's own attributes otherwise).
+    """
+    entry = {field: getattr(device, field) for field in FIELDS}
+    if entry["product"] in features_map:
+        entry["product_features"] = None  # looked up again from the product, without asking the device
+    entry["kind"] = type(device).__name__
+    for field in ("label", "group", "location"):
+        value = (keys or {}).get(field) or getattr(device, field)
+        entry[field] = value if isinstance(value, str) else None
+    return entry
+
+
+def save_inventory(path, entries):
+    """ Write entries as compact JSON, replacing path atomically so a crash never leaves half a file """
+    data = json.dumps({"version": INVENTORY_VERSION, "devices": entries}, separators=(",", ":"))
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_inventory(path):
+    """ Entries saved at path; [] when there is no usable inventory, which just means discovering as usual """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring device inventory {}: {}".format(path, e))
+        return []
+    if not isinstance(data, dict) or data.get("version") != INVENTORY_VERSION:
+        logging.warning("Ignoring device inventory {}: not version {}".format(path, INVENTORY_VERSION))
+        return []
+    entries = data.get("devices", [])
+    return [e for e in entries if isinstance(e, dict) and e.get("mac_addr") and e.get("port")]
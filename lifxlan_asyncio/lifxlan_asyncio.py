@@ -1,12 +1,111 @@
 import asyncio
+import heapq
+import logging
 
 from lifxlan import LifxLAN
+from lifxlan.device import DEFAULT_ATTEMPTS, DEFAULT_TIMEOUT
+from lifxlan.errors import InvalidParameterException, WorkflowException
+from lifxlan.message import BROADCAST_MAC
+from lifxlan.msgtypes import Acknowledgement, GetService, LightGet, LightGetPower, LightSetColor, LightSetPower, \
+    LightSetWaveform, LightState, LightStatePower, StateService
+
+from lifxlan_asyncio.animation import DEFAULT_FPS, Animation
+from lifxlan_asyncio.breaker import CircuitOpenException
+from lifxlan_asyncio.codec import PacketTemplate
+from lifxlan_asyncio.device import AsyncDevice, UDP_BROADCAST_PORT
+from lifxlan_asyncio.events import TRACKED_MSG_TYPES, StateTracker
+from lifxlan_asyncio.group import AsyncGroup
+from lifxlan_asyncio.health import DEFAULT_POLL_INTERVAL, HealthPoller
+from lifxlan_asyncio.interfaces import broadcast_addrs, get_interfaces
+from lifxlan_asyncio.inventory import device_entry, load_inventory, save_inventory
+from lifxlan_asyncio.light import Light, MultiZoneLight, TileChain
+from lifxlan_asyncio.metrics import Metrics
+from lifxlan_asyncio.ratelimit import DEFAULT_RATE_LIMIT
+from lifxlan_asyncio.registry import OBSERVED_MSG_TYPES, DeviceRegistry
+from lifxlan_asyncio.transport import AsyncTransport
+
+DEFAULT_REFRESH_CONCURRENCY = 32
 
 
 class AsyncLifxLAN(LifxLAN):
-    def __init__(self, *args, loop, **kwargs):
+    def __init__(self, *args, loop=None, rate_limit=DEFAULT_RATE_LIMIT, broadcast_addrs=None, broadcast_port=UDP_BROADCAST_PORT,
+                 metrics_hook=None, **kwargs):
         self.loop = loop
         super().__init__(*args, **kwargs)
+        self.metrics = Metrics(metrics_hook)
+        self.transport = AsyncTransport(loop=loop, verbose=self.verbose, rate_limit=rate_limit, metrics=self.metrics)
+        self.registry = DeviceRegistry()
+        self.transport.add_observer(self.registry.observe, OBSERVED_MSG_TYPES)
+        self.tracker = StateTracker(self.registry)
+        self.transport.add_observer(self.tracker.observe, TRACKED_MSG_TYPES)
+        self.health_poller = None
+        self.validation_task = None  # background check of a loaded inventory, see load_inventory()
+        # Broadcasts go out under a source id of their own: replies are matched on (target, sequence number,
+        # source id), and a unicast reply must never land in a broadcast's subscription
+        self.broadcast_source_id = self.source_id ^ 1  # source ids 0 and 1 are reserved, source_id is at least 2
+        self.packet_template = PacketTemplate(BROADCAST_MAC, self.broadcast_source_id)
+        # resolved on first use unless given; devices share this list, so a refresh reaches them too
+        self.broadcast_addrs = list(broadcast_addrs or [])
+        self.broadcast_port = broadcast_port
+
+    async def get_transport(self):
+        """ The endpoint shared by this client and every device it discovers """
+        return await self.transport.open()
+
+    async def get_broadcast_addrs(self):
+        if not self.broadcast_addrs:
+            await self.refresh_broadcast_addrs()
+        return self.broadcast_addrs
+
+    # Enumerate the network interfaces again, e.g. after a network change:
+    # each gets its own endpoint, and broadcasts go to every interface's subnet
+    async def refresh_broadcast_addrs(self):
+        interfaces = await get_interfaces()
+        transport = await self.get_transport()
+        await transport.open_interfaces(interfaces)
+        self.broadcast_addrs[:] = broadcast_addrs(interfaces)
+        return self.broadcast_addrs
+
+    # lifxlan's blocking socket, replaced by the shared transport: initialize_socket() opens it, close_socket() is close()
+    async def initialize_socket(self, timeout=None):
+        return await self.get_transport()
+
+    def close_socket(self):
+        self.close()
+
+    def close(self):
+        if self.health_poller is not None:
+            self.health_poller.stop()
+        if self.validation_task is not None:
+            self.validation_task.cancel()
+        for device in self.registry.devices():
+            device.close()
+        self.transport.close()
+
+    # Poll every discovered device in the background; health_poller.health maps MAC to DeviceHealth
+    def start_health_poller(self, interval=DEFAULT_POLL_INTERVAL):
+        if self.health_poller is None:
+            self.health_poller = HealthPoller(self.registry, interval)
+        self.health_poller.interval = interval
+        return self.health_poller.start()
+
+    # Power and color changes of known devices, as StateEvents, for as long as the caller iterates.
+    # Besides replies to requests, anything sent to the LIFX port is picked up when it can be shared.
+    async def events(self):
+        try:
+            await self.start_listener()
+        except WorkflowException as e:
+            logging.warning("Only tracking replies to this client's own requests: {}".format(e))
+        events = self.tracker.events()
+        try:
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()  # unsubscribe now, not whenever the iterator is collected
+
+    async def start_listener(self):
+        transport = await self.get_transport()
+        await transport.listen(self.broadcast_port)
 
     async def get_devices(self):
         async for d in self.discover_devices():
@@ -24,33 +123,188 @@ class AsyncLifxLAN(LifxLAN):
     # more of an internal helper function
     # forces a refresh of the internal list of available devices
     async def discover_devices(self):
+        """ Yield each device once its StateService has arrived and its GetVersion probe has returned
+
+        That is two round trips to the first device: the broadcast, then the
+        probe that decides its class. Probes run concurrently with each other
+        and with the rest of the discovery broadcast, so a slow or silent device
+        never delays the others.
+        """
         self.lights = []
         self.devices = []
-        responses = await self.broadcast_with_resp(GetService, StateService,)
-        async for r in responses:
-            device = Device(r.target_addr, r.ip_addr, r.service, r.port, self.source_id, self.verbose)
+        discovered = asyncio.Queue()
+
+        async def probe(response):
+            discovered.put_nowait(await self.classify_device(response))
+
+        async def collect():
+            probes = []
             try:
-                if device.is_light():
-                    if device.supports_multizone():
-                        device = MultiZoneLight(r.target_addr, r.ip_addr, r.service, r.port, self.source_id, self.verbose)
-                    elif device.supports_chain():
-                        device = TileChain(r.target_addr, r.ip_addr, r.service, r.port, self.source_id, self.verbose)
-                    else:
-                        device = Light(r.target_addr, r.ip_addr, r.service, r.port, self.source_id, self.verbose)
+                async for r in self.broadcast_with_resp_iter(GetService, StateService):
+                    probes.append(asyncio.ensure_future(probe(r)))
+                await asyncio.gather(*probes)
+            finally:
+                for p in probes:
+                    p.cancel()
+                discovered.put_nowait(None)
+
+        collector = asyncio.ensure_future(collect())
+        try:
+            while True:
+                device = await discovered.get()
+                if device is None:
+                    break
+                if isinstance(device, Light):
                     self.lights.append(device)
-                    yield device
-            except WorkflowException:
-                # cheating -- it just so happens that all LIFX devices are lights right now
-                device = Light(r.target_addr, r.ip_addr, r.service, r.port, self.source_id, self.verbose)
-                self.lights.append(device)
+                self.devices.append(device)
+                self.registry.add(device)
                 yield device
-        self.devices.append(device)
+            await collector  # surface errors from the discovery broadcast
+        finally:
+            collector.cancel()
+            await asyncio.gather(collector, return_exceptions=True)
+
+    async def classify_device(self, r):
+        """ Build the most specific device class for a StateService response """
+        device = self.make_device(AsyncDevice, r)
+        try:
+            if await device.is_light():
+                if await device.supports_multizone():
+                    cls = MultiZoneLight
+                elif await device.supports_chain():
+                    cls = TileChain
+                else:
+                    cls = Light
+            else:
+                return device
+        except WorkflowException:
+            # cheating -- it just so happens that all LIFX devices are lights right now
+            return self.make_device(Light, r)
+        light = self.make_device(cls, r)
+        # keep what the probe learned so the light doesn't ask again
+        light.vendor, light.product, light.version = device.vendor, device.product, device.version
+        light.product_features = device.product_features
+        light.rtt = device.rtt  # so its first requests already retransmit on the measured round trip
+        return light
+
+    def make_device(self, cls, r):
+        device = cls(r.target_addr, r.ip_addr, r.service, r.port, self.source_id, self.verbose, self.transport, self.broadcast_addrs)
+        device.interface = self.transport.interface_for(r.ip_addr)
+        return device
+
+    # Write every known device to path, for a later process to load_inventory() instead of discovering
+    def save_inventory(self, path):
+        save_inventory(path, [device_entry(d, self.registry.keys.get(d.mac_addr)) for d in self.registry.devices()])
+
+    async def load_inventory(self, path, validate=True):
+        """ Make the devices saved at path the known devices, ready to be controlled without any discovery
+
+        Lookups and the *_all_lights methods use them right away. With validate,
+        a background task (validation_task) then checks the inventory against the
+        network: see validate_inventory(). Returns the loaded devices, [] if
+        there was no usable inventory.
+        """
+        classes = {"AsyncDevice": AsyncDevice, "Light": Light, "MultiZoneLight": MultiZoneLight, "TileChain": TileChain}
+        devices = []
+        for entry in load_inventory(path):
+            cls = classes.get(entry["kind"], Light)
+            device = cls(entry["mac_addr"], entry["ip_addr"], entry["service"], entry["port"], self.source_id, self.verbose, self.transport, self.broadcast_addrs)
+            device.interface = self.transport.interface_for(entry["ip_addr"])
+            device.vendor, device.product, device.version = entry["vendor"], entry["product"], entry["version"]
+            device.product_features = entry["product_features"]
+            device.label, device.group, device.location = entry["label"], entry["group"], entry["location"]
+            devices.append(device)
+        if not devices:
+            return devices
+        self.devices = devices
+        self.lights = [d for d in devices if isinstance(d, Light)]
+        for device in devices:
+            self.registry.add(device)
+        if validate:
+            if self.validation_task is not None:
+                self.validation_task.cancel()
+            self.validation_task = asyncio.ensure_future(self.validate_inventory(path))
+        return devices
+
+    async def validate_inventory(self, path=None, max_concurrency=DEFAULT_REFRESH_CONCURRENCY):
+        """ Check the known devices against one discovery broadcast, without disturbing their use meanwhile
+
+        Devices that answer get their current address, have their product checked
+        (a different one replaces the device with a newly classified one) and
+        their label, group and location asked again; devices that were not known
+        yet are added. The inventory is saved back to path, if given. Returns
+        the known devices that did not answer, left in place in case they are
+        only briefly offline.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        answered = set()
+
+        async def validate(r):
+            async with semaphore:
+                device = self.registry.get_by_mac(r.target_addr)
+                if device is not None:
+                    device.ip_addr, device.port = r.ip_addr, r.port
+                    device.interface = self.transport.interface_for(r.ip_addr)
+                    vendor, product, version = await device.get_version_tuple(max_age=0)
+                    if product == device.product:
+                        await asyncio.gather(device.get_label(max_age=0), device.get_group(max_age=0), device.get_location(max_age=0))
+                        return
+                    self.forget(device)
+                device = await self.classify_device(r)
+                if isinstance(device, Light):
+                    self.lights.append(device)
+                self.devices.append(device)
+                self.registry.add(device)
+                await asyncio.gather(device.get_label(), device.get_group(), device.get_location())
+
+        if self.devices == None:
+            self.devices, self.lights = [], []
+        checks = []
+        try:
+            async for r in self.broadcast_with_resp_iter(GetService, StateService):
+                answered.add(r.target_addr)
+                checks.append(asyncio.ensure_future(validate(r)))
+            await asyncio.gather(*checks, return_exceptions=True)  # a device that stops answering just stays as it was
+        finally:
+            for check in checks:
+                check.cancel()
+        if path is not None:
+            self.save_inventory(path)
+        return [d for d in self.devices if d.mac_addr not in answered]
+
+    def forget(self, device):
+        """ Drop a known device, e.g. one replaced by different hardware under the same MAC """
+        self.registry.remove(device.mac_addr)
+        for devices in (self.devices, self.lights):
+            if devices is not None and device in devices:
+                devices.remove(device)
+
+    async def refresh_all(self, max_concurrency=DEFAULT_REFRESH_CONCURRENCY):
+        """ Refresh every known device, at most max_concurrency at a time
+
+        Returns a dict of device: exception for the devices that could not be
+        refreshed; one unreachable device does not abort the rest of the batch.
+        """
+        if self.devices == None:
+            await self.discover_devices_sync()
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def refresh(device):
+            async with semaphore:
+                await device.refresh()
+
+        results = await asyncio.gather(*(refresh(d) for d in self.devices), return_exceptions=True)
+        failures = {}
+        for device, result in zip(self.devices, results):
+            if isinstance(result, Exception):
+                failures[device] = result
+        return failures
 
     async def get_multizone_lights(self):
         multizone_lights = []
         all_lights = await self.get_lights()
         for l in all_lights:
-            if l.supports_multizone():
+            if await l.supports_multizone():
                 multizone_lights.append(l)
         return multizone_lights
 
@@ -58,7 +312,7 @@ class AsyncLifxLAN(LifxLAN):
         infrared_lights = []
         all_lights = await self.get_lights()
         for l in all_lights:
-            if l.supports_infrared():
+            if await l.supports_infrared():
                 infrared_lights.append(l)
         return infrared_lights
 
@@ -66,7 +320,7 @@ class AsyncLifxLAN(LifxLAN):
         color_lights = []
         all_lights = await self.get_lights()
         for l in all_lights:
-            if l.supports_color():
+            if await l.supports_color():
                 color_lights.append(l)
         return color_lights
 
@@ -74,66 +328,80 @@ class AsyncLifxLAN(LifxLAN):
         chain_lights = []
         all_lights = await self.get_lights()
         for l in all_lights:
-            if l.supports_chain():
+            if await l.supports_chain():
                 chain_lights.append(l)
         return chain_lights
 
+    async def index_devices(self, field):
+        """ Ask only the registered devices whose label/group/location is still unknown """
+        getters = {"label": "get_label", "group": "get_group", "location": "get_location"}
+        devices = self.registry.unknown(field)
+        # the registry picks the answers up from the transport; unreachable devices just stay unknown
+        await asyncio.gather(*(getattr(d, getters[field])() for d in devices), return_exceptions=True)
+
+    async def find_devices(self, field, values, rediscover=True):
+        """ Registry lookup of devices whose field is in values, rediscovering once on a miss """
+        if self.devices == None:
+            await self.discover_devices_sync()
+        await self.index_devices(field)
+        lookup = {"label": self.registry.get_by_label, "group": self.registry.get_by_group, "location": self.registry.get_by_location}[field]
+        devices = [d for v in values for d in lookup(v)]
+        missing = [v for v in values if not lookup(v)]
+        # an unreachable device that never told us its field misses every time, and rediscovering won't bring it back:
+        # only rediscover when there are more misses than such devices to blame them on
+        dead = [d for d in self.registry.unknown(field) if d.breaker.is_open]
+        if rediscover and len(missing) > len(dead):  # didn't find everything?
+            await self.discover_devices_sync()     # update list in case it is out of date
+            await self.index_devices(field)
+            devices = [d for v in values for d in lookup(v)]
+        return devices
+
     async def get_device_by_name(self, name):
-        device = None
-        all_devices = self.get_devices()
-        async for d in all_devices:
-            if await d.get_label() == name:
-                device = d
-        if device == None:               # didn't find it?
-            await self.discover_devices_sync()      # update list in case it is out of date
-            all_devices = self.get_devices()
-            async for d in all_devices:            # and try again
-                if d.get_label() == name:
-                    device = d
-        return device
+        devices = await self.find_devices("label", [name])
+        return devices[0] if devices else None
 
-        # takes in list of strings, returns Group of devices
+        # takes in list of strings, returns AsyncGroup of devices
     async def get_devices_by_name(self, names):
-        devices = []
-        all_devices = self.get_devices()
-        async for d in all_devices:
-            if d.get_label() in names:
-                devices.append(d)
-        if len(devices) != len(names):  # didn't find everything?
-            await self.discover_devices_sync()     # update list in case it is out of date
-            all_devices = self.get_devices()
-            async for d in all_devices:       # and try again
-                if d.get_label() in names:
-                    devices.append(d)
-        return Group(devices)
+        return AsyncGroup(self, await self.find_devices("label", names))
 
     async def get_devices_by_group(self, group):
-        devices = []
-        all_devices = self.get_devices()
-        async for d in all_devices:
-            if d.get_group() == group:
-                devices.append(d)
-        return Group(devices)
+        return AsyncGroup(self, await self.find_devices("group", [group], rediscover=False))
 
     async def get_devices_by_location(self, location):
-        devices = []
-        all_devices = self.get_devices()
-        async for d in all_devices:
-            if d.get_location() == location:
-                devices.append(d)
-        return Group(devices)
+        return AsyncGroup(self, await self.find_devices("location", [location], rediscover=False))
+
+    # takes in list of product names, returns AsyncGroup of devices
+    async def get_devices_by_product(self, names, rediscover=True):
+        if self.devices == None:
+            await self.discover_devices_sync()
+        devices = [d for d in self.devices if await d.get_product_name() in names]
+        if rediscover and {await d.get_product_name() for d in devices} != set(names):  # didn't find everything?
+            await self.discover_devices_sync()  # update list in case it is out of date
+            devices = [d for d in self.devices if await d.get_product_name() in names]
+        return AsyncGroup(self, devices)
 
         # returns dict of Light: power_level pairs
     async def get_power_all_lights(self):
-        responses = await self.broadcast_with_resp(LightGetPower, LightStatePower)
         power_states = {}
+        async for light, power_level in self.iter_power_all_lights():
+            power_states[light] = power_level
+        return power_states
+
+    # yields (Light, power_level) pairs as the responses arrive
+    async def iter_power_all_lights(self):
+        async for light, response in self.iter_lights_with_resp(LightGetPower, LightStatePower):
+            yield light, response.power_level
+
+    # yields (Light, response) pairs as the responses to a broadcast arrive, matched to known lights by MAC
+    async def iter_lights_with_resp(self, msg_type, response_type, payload={}):
         if self.lights == None:
             await self.discover_devices_sync()
-        for light in self.lights:
-            for response in responses:
-                if light.mac_addr == response.target_addr:
-                    power_states[light] = response.power_level
-        return power_states
+        lights_by_mac = {light.mac_addr: light for light in self.lights}
+        async for response in self.broadcast_with_resp_iter(msg_type, response_type, payload):
+            light = lights_by_mac.get(response.target_addr)
+            if light is not None:
+                light.cache.put(response)
+                yield light, response
 
     async def set_power_all_lights(self, power_level, duration=0, rapid=False):
         on = [True, 1, "on", 65535]
@@ -152,17 +420,24 @@ class AsyncLifxLAN(LifxLAN):
         except WorkflowException as e:
             raise
 
-    async def get_color_all_lights(self):
-        responses = await self.broadcast_with_resp(LightGet, LightState)
-        colors = {}
+    # Play an effect (see lifxlan_asyncio.animation) across all lights, discovering them first if needed.
+    # Returns the number of frames dropped to keep time.
+    async def animate(self, effect, duration, fps=DEFAULT_FPS, repeat=1):
         if self.lights == None:
             await self.discover_devices_sync()
-        for light in self.lights:
-            for response in responses:
-                if light.mac_addr == response.target_addr:
-                    colors[light] = response.color
+        return await Animation(self.lights, effect, duration, fps).play(repeat)
+
+    async def get_color_all_lights(self):
+        colors = {}
+        async for light, color in self.iter_color_all_lights():
+            colors[light] = color
         return colors
 
+    # yields (Light, color) pairs as the responses arrive
+    async def iter_color_all_lights(self):
+        async for light, response in self.iter_lights_with_resp(LightGet, LightState):
+            yield light, response.color
+
     async def set_color_all_lights(self, color, duration=0, rapid=False):
         if len(color) == 4:
             try:
@@ -187,83 +462,208 @@ class AsyncLifxLAN(LifxLAN):
         else:
             raise InvalidParameterException("{} is not a valid color.".format(color))
 
+    # takes dict of Light: [h, s, b, k] pairs, returns dict of Light: WorkflowException for lights that didn't ack
+    async def set_colors(self, colors, duration=0, rapid=False):
+        payloads = {}
+        for light, color in colors.items():
+            if len(color) != 4:
+                raise InvalidParameterException("{} is not a valid color.".format(color))
+            payloads[light] = {"color": color, "duration": duration}
+        return await self.unicast(LightSetColor, payloads, rapid)
+
+    # takes dict of Light: power_level pairs, returns dict of Light: WorkflowException for lights that didn't ack
+    async def set_powers(self, power_levels, duration=0, rapid=False):
+        on = [True, 1, "on", 65535]
+        off = [False, 0, "off"]
+        payloads = {}
+        for light, power_level in power_levels.items():
+            if power_level in on:
+                payloads[light] = {"power_level": 65535, "duration": duration}
+            elif power_level in off:
+                payloads[light] = {"power_level": 0, "duration": duration}
+            else:
+                raise InvalidParameterException("{} is not a valid power level.".format(power_level))
+        return await self.unicast(LightSetPower, payloads, rapid)
+
+    # takes dict of Light: {"is_transient", "color", "period", "cycles", "duty_cycle", "waveform"} dicts,
+    # returns dict of Light: WorkflowException for lights that didn't ack
+    async def set_waveforms(self, waveforms, rapid=False):
+        payloads = {}
+        for light, w in waveforms.items():
+            if len(w["color"]) != 4:
+                raise InvalidParameterException("{} is not a valid color.".format(w["color"]))
+            payloads[light] = {"transient": w["is_transient"], "color": w["color"], "period": w["period"], "cycles": w["cycles"], "duty_cycle": w["duty_cycle"], "waveform": w["waveform"]}
+        return await self.unicast(LightSetWaveform, payloads, rapid)
+
+    async def unicast(self, msg_type, payloads, rapid=False, timeout_secs=None, max_attempts=None):
+        if rapid:
+            await self.unicast_fire_and_forget(msg_type, payloads)
+            return {}
+        return await self.unicast_with_ack(msg_type, payloads, timeout_secs, max_attempts)
+
+    # A device made outside this client (e.g. constructed directly and put in a group) has no transport yet:
+    # give it this client's, so its requests share the socket, pacing and metrics of the batches it is sent in
+    def adopt(self, device):
+        if device.transport is None:
+            device.transport = self.transport
+            if device.broadcast_addrs is None:
+                device.broadcast_addrs = self.broadcast_addrs
+        return device
+
+    # Send a different payload to each device, without waiting for anything but a send slot. Goes through each
+    # device's fire_and_forget, so a Set still queued there is replaced rather than sent after this newer one.
+    async def unicast_fire_and_forget(self, msg_type, payloads):
+        await asyncio.gather(*(self.adopt(device).fire_and_forget(msg_type, payload, num_repeats=1) for device, payload in payloads.items()))
+
+    # Send a different payload to each device in one pass, then collect every ack as it arrives. Each device
+    # runs its own retransmit schedule (see AsyncDevice.retransmit_timeouts) from the moment its own message
+    # went out, so one slow device neither delays the others' retransmits nor stretches their measured RTT.
+    # Returns dict of device: WorkflowException for the devices that never acked.
+    async def unicast_with_ack(self, msg_type, payloads, timeout_secs=None, max_attempts=None):
+        transport = await self.get_transport()
+        acks = asyncio.Queue()
+        pending = {}    # mac -> [device, msg, subscription, timeouts, attempt, sent_at, first_sent_at]
+        deadlines = []  # heap of (deadline, mac, attempt); entries of devices that acked or moved on are skipped
+        failures = {}
+        for device, payload in payloads.items():
+            self.adopt(device)
+            if not device.breaker.allow():
+                failures[device] = CircuitOpenException("CircuitOpenException: {} (Name: {}) is not responding, waiting for it to answer a probe".format(str(device.mac_addr), str(device.label)))
+                continue
+            seq_num = await transport.acquire_seq_num(device.mac_addr)
+            msg = device.packet_template.encode(msg_type, seq_num, payload, ack_requested=True, response_requested=False)
+            subscription = transport.subscribe(device.mac_addr, seq_num, device.source_id, acks)
+            pending[device.mac_addr] = [device, msg, subscription, device.retransmit_timeouts(timeout_secs, max_attempts), 0, None, None]
+        loop = asyncio.get_running_loop()
+        try:
+            for mac_addr, entry in list(pending.items()):
+                await entry[0].send(transport, entry[1])
+                entry[5] = entry[6] = loop.time()
+                heapq.heappush(deadlines, (entry[5] + entry[3][0], mac_addr, 0))
+            while pending:
+                deadline, mac_addr, attempt = deadlines[0]
+                try:
+                    if acks.empty():
+                        response, (ip_addr, port) = await asyncio.wait_for(acks.get(), deadline - loop.time())
+                    else:
+                        response, (ip_addr, port) = acks.get_nowait()  # what already arrived counts before any deadline
+                except asyncio.TimeoutError:
+                    heapq.heappop(deadlines)
+                    entry = pending.get(mac_addr)
+                    if entry is None or entry[4] != attempt:
+                        continue
+                    device, msg, subscription, timeouts = entry[:4]
+                    if attempt + 1 < len(timeouts):
+                        await device.send(transport, msg)
+                        entry[4] = attempt + 1
+                        entry[5] = loop.time()
+                        heapq.heappush(deadlines, (entry[5] + timeouts[attempt + 1], mac_addr, attempt + 1))
+                    else:
+                        del pending[mac_addr]
+                        subscription.close()
+                        device.record_result(msg_type, None, attempt + 1)
+                        failures[device] = WorkflowException("WorkflowException: Did not receive {} from {} (Name: {}) in response to {}".format(str([Acknowledgement]), str(device.mac_addr), str(device.label), str(msg_type)))
+                    continue
+                if type(response) == Acknowledgement and response.target_addr in pending:
+                    device, msg, subscription, timeouts, attempt, sent_at, first_sent_at = pending.pop(response.target_addr)
+                    subscription.close()
+                    device.ip_addr = ip_addr
+                    device.cache.invalidate(msg_type)
+                    if attempt == 0:
+                        device.rtt.update(loop.time() - sent_at)  # only an ack to a message sent once (Karn)
+                    device.record_result(msg_type, loop.time() - first_sent_at, attempt + 1)
+        finally:
+            for entry in pending.values():
+                entry[2].close()
+        return failures
+
     async def broadcast_fire_and_forget(self, msg_type, payload={}, timeout_secs=DEFAULT_TIMEOUT, num_repeats=DEFAULT_ATTEMPTS):
-        self.initialize_socket(timeout_secs)
-        msg = msg_type(BROADCAST_MAC, self.source_id, seq_num=0, payload=payload, ack_requested=False, response_requested=False)
+        transport = await self.get_transport()
+        seq_num = transport.next_seq_num(BROADCAST_MAC)
+        msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=False, response_requested=False)
         sent_msg_count = 0
-        sleep_interval = 0.05 if num_repeats > 20 else 0
         while(sent_msg_count < num_repeats):
-            for ip_addr in UDP_BROADCAST_IP_ADDRS:
-                await self.sock.sendto(msg.packed_message, (ip_addr, UDP_BROADCAST_PORT))
-            if self.verbose:
-                print("SEND: " + str(msg))
+            for ip_addr in await self.get_broadcast_addrs():
+                await transport.sendto(msg, (ip_addr, self.broadcast_port))  # paced per broadcast domain
             sent_msg_count += 1
-            asyncio.sleep(sleep_interval) # Max num of messages device can handle is 20 per second.
-        self.close_socket()
 
     async def broadcast_with_resp(self, msg_type, response_type, payload={}, timeout_secs=DEFAULT_TIMEOUT, max_attempts=DEFAULT_ATTEMPTS):
-        self.initialize_socket(timeout_secs)
+        responses = []
+        async for response in self.broadcast_with_resp_iter(msg_type, response_type, payload, timeout_secs, max_attempts):
+            responses.append(response)
+        return responses
+
+    # Same workflow as broadcast_with_resp, but each device's response is yielded the moment it arrives
+    async def broadcast_with_resp_iter(self, msg_type, response_type, payload={}, timeout_secs=DEFAULT_TIMEOUT, max_attempts=DEFAULT_ATTEMPTS):
+        transport = await self.get_transport()
+        seq_num = await transport.acquire_seq_num(BROADCAST_MAC)
         if response_type == Acknowledgement:
-            msg = msg_type(BROADCAST_MAC, self.source_id, seq_num=0, payload=payload, ack_requested=True, response_requested=False)
+            msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=True, response_requested=False)
         else:
-            msg = msg_type(BROADCAST_MAC, self.source_id, seq_num=0, payload=payload, ack_requested=False, response_requested=True)
-        responses = []
-        addr_seen = []
-        num_devices_seen = 0
+            msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=False, response_requested=True)
+        addr_seen = set()
         attempts = 0
-        while (self.num_devices == None or num_devices_seen < self.num_devices) and attempts < max_attempts:
-            sent = False
-            start_time = time()
-            timedout = False
-            while (self.num_devices == None or num_devices_seen < self.num_devices) and not timedout:
-                if not sent:
-                    for ip_addr in UDP_BROADCAST_IP_ADDRS:
-                        self.sock.sendto(msg.packed_message, (ip_addr, UDP_BROADCAST_PORT))
-                    sent = True
-                    if self.verbose:
-                        print("SEND: " + str(msg))
-                try:
-                    data, (ip_addr, port) = self.sock.recvfrom(1024)
-                    response = unpack_lifx_message(data)
-                    response.ip_addr = ip_addr
-                    if self.verbose:
-                        print("RECV: " + str(response))
-                    if type(response) == response_type and response.source_id == self.source_id:
+        loop = asyncio.get_running_loop()
+        with transport.subscribe(BROADCAST_MAC, seq_num, self.broadcast_source_id) as subscription:
+            while (self.num_devices == None or len(addr_seen) < self.num_devices) and attempts < max_attempts:
+                for ip_addr in await self.get_broadcast_addrs():
+                    await transport.sendto(msg, (ip_addr, self.broadcast_port))
+                deadline = loop.time() + timeout_secs
+                while self.num_devices == None or len(addr_seen) < self.num_devices:
+                    try:
+                        response, (ip_addr, port) = await subscription.recv(deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                    if type(response) == response_type:
                         if response.target_addr not in addr_seen and response.target_addr != BROADCAST_MAC:
-                            addr_seen.append(response.target_addr)
-                            num_devices_seen += 1
-                            responses.append(response)
-                except timeout:
-                    pass
-                elapsed_time = time() - start_time
-                timedout = True if elapsed_time > timeout_secs else False
-            attempts += 1
-        self.close_socket()
-        return responses
+                            addr_seen.add(response.target_addr)
+                            yield response
+                attempts += 1
 
     async def broadcast_with_ack(self, msg_type, payload={}, timeout_secs=DEFAULT_TIMEOUT+0.5, max_attempts=DEFAULT_ATTEMPTS):
         await self.broadcast_with_resp(msg_type, Acknowledgement, payload, timeout_secs, max_attempts)
 
-        # Not currently implemented, although the LIFX LAN protocol supports this kind of workflow natively
+    # One broadcast asks every device for both an ack and its resulting state.
+    # Returns the state responses of the devices that sent both.
     async def broadcast_with_ack_resp(self, msg_type, response_type, payload={}, timeout_secs=DEFAULT_TIMEOUT+0.5, max_attempts=DEFAULT_ATTEMPTS):
-        pass
-
-    def initialize_socket(self, timeout):
-        self.sock = socket(AF_INET, SOCK_DGRAM)
-        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.sock.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-        self.sock.settimeout(timeout)
-        try:
-            self.sock.bind(("", 0))  # allow OS to assign next available source port
-        except Exception as err:
-            raise WorkflowException("WorkflowException: error {} while trying to open socket".format(str(err)))
-
-    def close_socket(self):
-        self.sock.close()
+        transport = await self.get_transport()
+        seq_num = await transport.acquire_seq_num(BROADCAST_MAC)
+        msg = self.packet_template.encode(msg_type, seq_num, payload, ack_requested=True, response_requested=True)
+        acked = set()
+        responses = {}
+        complete = {}
+        attempts = 0
+        loop = asyncio.get_running_loop()
+        with transport.subscribe(BROADCAST_MAC, seq_num, self.broadcast_source_id) as subscription:
+            while (self.num_devices == None or len(complete) < self.num_devices) and attempts < max_attempts:
+                for ip_addr in await self.get_broadcast_addrs():
+                    await transport.sendto(msg, (ip_addr, self.broadcast_port))
+                deadline = loop.time() + timeout_secs
+                while self.num_devices == None or len(complete) < self.num_devices:
+                    try:
+                        response, (ip_addr, port) = await subscription.recv(deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                    mac_addr = response.target_addr
+                    if mac_addr == BROADCAST_MAC:
+                        continue
+                    if type(response) == Acknowledgement:
+                        acked.add(mac_addr)
+                    elif type(response) == response_type and mac_addr not in responses:
+                        responses[mac_addr] = response
+                    else:
+                        continue
+                    if mac_addr in acked and mac_addr in responses:
+                        complete[mac_addr] = responses[mac_addr]
+                attempts += 1
+        return list(complete.values())
 
 
+# Smoke run against a few simulated devices on localhost; see lifxlan_asyncio.benchmark for the full benchmark
 def test():
-    pass
+    from lifxlan_asyncio.benchmark import HEADER, format_row, run
+    print(HEADER)
+    print(format_row(asyncio.run(run(4, multizone_count=1, tile_count=1))))
 
 
 if __name__ == "__main__":
@@ -1,4 +1,10 @@
-from lifxlan import Device
+import asyncio
+
+from lifxlan.msgtypes import MultiZoneSetExtendedColorZones, SetTileState64
+
+from lifxlan_asyncio.codec import EXTENDED_COLOR_ZONES, EXTENDED_ZONE_COUNT, SET_TILE_STATE_64, TILE_ZONE_COUNT, \
+    pack_colors, split_colors
+from lifxlan_asyncio.device import AsyncDevice
 
 RED = [65535, 65535, 65535, 3500]
 ORANGE = [6500, 65535, 65535, 3500]
@@ -14,5 +20,48 @@ WARM_WHITE = [58275, 0, 65535, 3200]
 GOLD = [58275, 0, 65535, 2500]
 
 
-class Light(Device):
+class Light(AsyncDevice):
     pass
+
+
+class MultiZoneLight(Light):
+    # Sets zones index, index+1, ... to colors (an n x 4 array, a flat array('H') or a list of HSBK colors)
+    # in as few SetExtendedColorZones as possible, 82 zones each. Only the last one applies the change,
+    # so the whole strip updates at once; without rapid each packet is acked before the next is sent.
+    # Positional arguments are lifxlan's; index and apply are keyword-only.
+    async def set_zone_colors(self, colors, duration=0, rapid=False, *, index=0, apply=1):
+        packed = pack_colors(colors)
+        chunks = list(split_colors(packed, EXTENDED_ZONE_COUNT))
+        for i, (offset, chunk_count, chunk) in enumerate(chunks):
+            apply_flag = apply if i == len(chunks) - 1 else 0
+            payload = EXTENDED_COLOR_ZONES.pack(duration, apply_flag, index + offset, chunk_count) + chunk
+            if rapid:
+                await self.fire_and_forget(MultiZoneSetExtendedColorZones, payload, num_repeats=1)
+            else:
+                await self.req_with_ack(MultiZoneSetExtendedColorZones, payload)
+
+
+class TileChain(Light):
+    # Sets tiles start_index, start_index+1, ... from colors holding 64 colors per tile (an n x 4 array,
+    # a flat array('H') or a list of HSBK colors), one SetTileState64 per tile; a short last tile is padded with black.
+    # With tile_count, as in lifxlan, the first 64 colors go to tile_count tiles in one packet instead.
+    async def set_tile_colors(self, start_index, colors, duration=0, tile_count=None, x=0, y=0, width=8, rapid=False):
+        packed = pack_colors(colors)
+        chunks = list(split_colors(packed, TILE_ZONE_COUNT))
+        if tile_count is not None:
+            chunks = chunks[:1]
+        requests = []
+        for offset, chunk_count, chunk in chunks:
+            tile_index = start_index + offset // TILE_ZONE_COUNT
+            payload = SET_TILE_STATE_64.pack(tile_index, tile_count or 1, x, y, width, duration) + chunk
+            if rapid:
+                requests.append(self.fire_and_forget(SetTileState64, payload, num_repeats=1))
+            else:
+                requests.append(self.req_with_ack(SetTileState64, payload))
+        await asyncio.gather(*requests)
+
+    # tilechain_colors: one 64-color buffer per tile, or a single buffer of all of them back to back
+    async def set_tilechain_colors(self, tilechain_colors, duration=0, rapid=False):
+        if isinstance(tilechain_colors, list) and tilechain_colors and len(tilechain_colors[0]) == TILE_ZONE_COUNT:
+            tilechain_colors = [color for tile_colors in tilechain_colors for color in tile_colors]
+        await self.set_tile_colors(0, tilechain_colors, duration, rapid=rapid)
@@ -0,0 +1,131 @@
+import logging
+from bisect import bisect_left
+
+# upper bounds, in seconds, of the RTT histogram buckets; anything slower lands in a last, open-ended one
+DEFAULT_RTT_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 4.0)
+
+
+class Histogram:
+    """ Fixed-bucket histogram: recording a value is one bisect and two additions """
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds=DEFAULT_RTT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """ Upper bound of the bucket holding the given fraction of the values (the maximum for the last bucket) """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "buckets": list(zip(self.bounds + (None,), self.counts)),
+        }
+
+
+class DeviceMetrics:
+    """ Packet counters, request outcomes and RTT histograms (by request message type) of one device """
+    __slots__ = ("sent", "received", "requests", "retried", "timeouts", "rtt")
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.requests = 0
+        self.retried = 0   # retransmissions
+        self.timeouts = 0  # requests that got no answer within all their attempts
+        self.rtt = {}      # request message type -> Histogram of seconds from the first send to the answer
+
+    @property
+    def timeout_rate(self):
+        return self.timeouts / self.requests if self.requests else 0.0
+
+    def snapshot(self):
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "requests": self.requests,
+            "retried": self.retried,
+            "timeouts": self.timeouts,
+            "timeout_rate": self.timeout_rate,
+            "rtt": {msg_type.__name__: histogram.snapshot() for msg_type, histogram in self.rtt.items()},
+        }
+
+
+class Metrics:
+    """ Counters kept by an AsyncTransport and the requests that go through it
+
+    sent and received count every packet, dropped the received ones that were
+    discarded: malformed, or answering nothing still outstanding (typically a
+    late reply to a request that already timed out or was retransmitted).
+    devices holds a DeviceMetrics per MAC. hook, if set, is called as
+    hook(mac_addr, msg_type, rtt, attempts) when a request completes, with
+    rtt None if it timed out.
+    """
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.retried = 0
+        self.devices = {}  # mac -> DeviceMetrics
+
+    def device(self, mac_addr):
+        metrics = self.devices.get(mac_addr)
+        if metrics is None:
+            metrics = self.devices[mac_addr] = DeviceMetrics()
+        return metrics
+
+    def record_request(self, mac_addr, msg_type, rtt, attempts):
+        metrics = self.device(mac_addr)
+        metrics.requests += 1
+        metrics.retried += attempts - 1
+        self.retried += attempts - 1
+        if rtt is None:
+            metrics.timeouts += 1
+        else:
+            histogram = metrics.rtt.get(msg_type)
+            if histogram is None:
+                histogram = metrics.rtt[msg_type] = Histogram()
+            histogram.observe(rtt)
+        if self.hook is not None:
+            try:
+                self.hook(mac_addr, msg_type, rtt, attempts)
+            except Exception:
+                logging.exception("Metrics hook failed")
+
+    def snapshot(self):
+        """ Plain dict of every counter and histogram, e.g. for logging or export as JSON """
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "dropped": self.dropped,
+            "retried": self.retried,
+            "devices": {mac_addr: metrics.snapshot() for mac_addr, metrics in self.devices.items()},
+        }
+
+    def reset(self):
+        self.sent = self.received = self.dropped = self.retried = 0
+        self.devices.clear()
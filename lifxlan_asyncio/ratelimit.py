@@ -0,0 +1,82 @@
+import asyncio
+from time import monotonic
+
+DEFAULT_RATE_LIMIT = 20  # Max num of messages a device can handle per second.
+DEFAULT_BURST = 5        # Messages a device buffers without dropping any.
+
+
+class TokenBucket:
+    """ Token bucket that paces callers to rate messages/s with bursts of up to burst messages
+
+    acquire() reserves the next free slot before sleeping, so concurrent callers
+    are served in arrival order and smoothed out instead of all waking at once.
+    """
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = monotonic()
+
+    def reserve(self):
+        """ Take a token, returning how long the caller has to wait before using it """
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate)
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def try_acquire(self):
+        """ Take a token only if one is available right now """
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class SendScheduler:
+    """ One TokenBucket per destination: a device MAC for unicast, a broadcast address for broadcast
+
+    A broadcast is also charged to the buckets of the devices it reaches, see acquire_all().
+    """
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    async def acquire(self, key):
+        if self.rate is None:
+            return
+        await self.bucket(key).acquire()
+
+    async def acquire_all(self, keys):
+        """ Take a token from every key's bucket, waiting until the last of them is free """
+        if self.rate is None:
+            return
+        delay = max(self.bucket(key).reserve() for key in keys)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def charge(self, key):
+        """ Take a token without waiting, for a message that already went out; the next acquire() waits the longer """
+        if self.rate is not None:
+            self.bucket(key).reserve()
+
+    def try_acquire(self, key):
+        """ Non-blocking acquire, for senders that would rather drop a message than queue it """
+        if self.rate is None:
+            return True
+        return self.bucket(key).try_acquire()
@@ -0,0 +1,100 @@
+from lifxlan.msgtypes import LightState, StateGroup, StateLabel, StateLocation
+
+# State packets the registry folds into its indexes
+OBSERVED_MSG_TYPES = [StateLabel, StateGroup, StateLocation, LightState]
+
+
+class DeviceRegistry:
+    """ In-memory index of known devices by MAC, label, group and location
+
+    Discovery adds devices, and every StateLabel/StateGroup/StateLocation/
+    LightState packet seen on the transport keeps the indexes current, so
+    lookups are dictionary hits that cost no packets.
+    """
+    def __init__(self):
+        self.by_mac = {}
+        self.by_label = {}
+        self.by_group = {}
+        self.by_location = {}
+        # mac -> {"label": ..., "group": ..., "location": ...} as currently indexed, None when unknown
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.by_mac)
+
+    def __contains__(self, mac_addr):
+        return mac_addr in self.by_mac
+
+    def devices(self):
+        return list(self.by_mac.values())
+
+    def add(self, device):
+        """ Index a (re)discovered device, keeping whatever was already known about its MAC """
+        mac_addr = device.mac_addr
+        self.by_mac[mac_addr] = device
+        keys = self.keys.setdefault(mac_addr, {"label": None, "group": None, "location": None})
+        for field, value in list(keys.items()):
+            if value is None:
+                value = getattr(device, field)
+                if isinstance(value, str):
+                    self.update(mac_addr, field, value)
+            else:
+                # swap the new object into the index and give it the known value
+                self.index(field)[value][mac_addr] = device
+                setattr(device, field, value)
+
+    def remove(self, mac_addr):
+        self.by_mac.pop(mac_addr, None)
+        for field, value in self.keys.pop(mac_addr, {}).items():
+            self.unindex(field, value, mac_addr)
+
+    def index(self, field):
+        return {"label": self.by_label, "group": self.by_group, "location": self.by_location}[field]
+
+    def unindex(self, field, value, mac_addr):
+        index = self.index(field)
+        devices = index.get(value)
+        if devices is not None:
+            devices.pop(mac_addr, None)
+            if not devices:
+                del index[value]
+
+    def update(self, mac_addr, field, value):
+        device = self.by_mac.get(mac_addr)
+        if device is None:
+            return
+        keys = self.keys[mac_addr]
+        old_value = keys[field]
+        if old_value != value:
+            if old_value is not None:
+                self.unindex(field, old_value, mac_addr)
+            self.index(field).setdefault(value, {})[mac_addr] = device
+            keys[field] = value
+
+    def unknown(self, field):
+        """ Devices whose field has never been reported """
+        return [self.by_mac[mac] for mac, keys in self.keys.items() if keys[field] is None and mac in self.by_mac]
+
+    def observe(self, response, addr):
+        """ Transport observer: fold state responses into the indexes """
+        if response.target_addr not in self.by_mac:
+            return
+        response_type = type(response)
+        if response_type in (StateLabel, LightState):
+            self.update(response.target_addr, "label", response.label)
+        elif response_type == StateGroup:
+            self.update(response.target_addr, "group", response.label)
+        elif response_type == StateLocation:
+            self.update(response.target_addr, "location", response.label)
+
+    def get_by_mac(self, mac_addr):
+        return self.by_mac.get(mac_addr)
+
+    def get_by_label(self, label):
+        return list(self.by_label.get(label, {}).values())
+
+    def get_by_group(self, group):
+        return list(self.by_group.get(group, {}).values())
+
+    def get_by_location(self, location):
+        return list(self.by_location.get(location, {}).values())
@@ -0,0 +1,46 @@
+from lifxlan.device import DEFAULT_ATTEMPTS, DEFAULT_TIMEOUT
+
+MIN_RTO = 0.1   # seconds; Wi-Fi power save alone can delay a healthy bulb's reply this long
+MAX_RTO = 4.0
+ALPHA = 1 / 8   # RFC 6298 smoothing gains
+BETA = 1 / 4
+
+
+class RttEstimator:
+    """ Smoothed round-trip time and variance of one device, TCP style (RFC 6298) """
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def update(self, rtt):
+        """ Fold in a measured round trip; only pass replies to a message that was sent once (Karn) """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.samples += 1
+
+    @property
+    def rto(self):
+        if self.srtt is None:
+            return DEFAULT_TIMEOUT
+        return min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def timeouts(self, budget=DEFAULT_TIMEOUT * DEFAULT_ATTEMPTS):
+        """ Per-attempt timeouts: start at the RTO and double each retry until budget seconds are spent
+
+        A responsive device gets fast retransmits, a slow one gets few long waits,
+        and either way the request gives up after the same total time.
+        """
+        timeouts = []
+        timeout = self.rto
+        spent = 0
+        while spent < budget:
+            timeout = min(timeout, budget - spent)
+            timeouts.append(timeout)
+            spent += timeout
+            timeout = min(MAX_RTO, timeout * 2)
+        return timeouts
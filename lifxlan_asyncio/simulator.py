@@ -0,0 +1,302 @@
+import asyncio
+import random
+import struct
+from time import time
+
+from lifxlan.message import BROADCAST_MAC, HEADER_SIZE_BYTES
+from lifxlan.msgtypes import Acknowledgement, GetGroup, GetHostFirmware, GetInfo, GetLabel, GetLocation, GetPower, \
+    GetService, GetTileState64, GetVersion, GetWifiFirmware, GetWifiInfo, LightGet, LightGetPower, LightSetColor, \
+    LightSetPower, LightSetWaveform, LightState, LightStatePower, MSG_IDS, MultiZoneGetExtendedColorZones, \
+    MultiZoneSetExtendedColorZones, MultiZoneStateExtendedColorZones, SetLabel, SetPower, SetTileState64, StateGroup, \
+    StateHostFirmware, StateInfo, StateLabel, StateLocation, StatePower, StateService, StateTileState64, StateVersion, \
+    StateWifiFirmware, StateWifiInfo
+
+from lifxlan_asyncio.codec import COLOR, EXTENDED_COLOR_ZONES, EXTENDED_ZONE_COUNT, FLAGS_OFFSET, HSBK_SIZE, \
+    LIGHT_POWER, POWER, SET_TILE_STATE_64, TILE_ZONE_COUNT, WAVEFORM, WIFI_INFO, PacketTemplate, peek_header
+from lifxlan_asyncio.ratelimit import DEFAULT_BURST, DEFAULT_RATE_LIMIT, TokenBucket
+
+COLOR_PRODUCT = 27      # LIFX A19
+MULTIZONE_PRODUCT = 32  # LIFX Z
+TILE_PRODUCT = 55       # LIFX Tile
+DEFAULT_ZONE_COUNT = 16
+DEFAULT_TILE_COUNT = 5
+FIRMWARE_VERSION = 3 << 16 | 70  # 3.70, new enough for extended multizone
+SERVICE_UDP = 1
+ACK_REQUESTED = 2
+RESPONSE_REQUESTED = 1
+
+SERVICE = struct.Struct("<BI")
+VERSION = struct.Struct("<III")
+FIRMWARE = struct.Struct("<QQI")
+INFO = struct.Struct("<QQQ")
+GROUP = struct.Struct("<16s32sQ")               # group or location id, label, updated at
+LIGHT_STATE = struct.Struct("<HHHHhH32sQ")      # color, reserved, power, label, reserved
+EXTENDED_ZONES_STATE = struct.Struct("<HHB")    # zone count, first index, colors count; then 82 colors
+GET_TILE_STATE_64 = struct.Struct("<BBxBBB")    # tile index, length, reserved, x, y, width
+TILE_STATE_64 = struct.Struct("<BxBBB")         # tile index, reserved, x, y, width; then 64 colors
+
+
+def encode_label(label):
+    return label.encode("utf-8")[:32].ljust(32, b"\0")
+
+
+def decode_label(data):
+    return data[:32].rstrip(b"\0").decode("utf-8", "replace")
+
+
+class VirtualBulb:
+    """ One simulated device: its state, and its answer to each message type
+
+    Get messages are always answered; Sets change the state and are answered
+    only when the sender asked for a response. A bulb admits rate_limit
+    messages/s (with bursts of burst) and silently drops the rest, like a real one.
+    """
+    def __init__(self, mac_addr, label="", group="", location="", product=COLOR_PRODUCT, zone_count=0, tile_count=0,
+                 rate_limit=DEFAULT_RATE_LIMIT, burst=DEFAULT_BURST):
+        self.mac_addr = mac_addr
+        self.label = label
+        self.group = group
+        self.location = location
+        self.product = product
+        self.power_level = 0
+        self.color = (0, 0, 0, 3500)
+        self.signal_mw = 3.2e-5
+        self.zones = bytearray(zone_count * HSBK_SIZE)
+        self.tiles = [bytearray(TILE_ZONE_COUNT * HSBK_SIZE) for _ in range(tile_count)]
+        self.bucket = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.port = None  # UDP port of the fleet, advertised in StateService
+        self.started_at = time()
+        self.templates = {}  # source id -> PacketTemplate for replies to that client
+
+    def admit(self):
+        return self.bucket is None or self.bucket.try_acquire()
+
+    def encode(self, msg_type, source_id, seq_num, payload):
+        template = self.templates.get(source_id)
+        if template is None:
+            template = self.templates[source_id] = PacketTemplate(self.mac_addr, source_id)
+        return template.encode_packed(msg_type, seq_num, payload).packed_message
+
+    def handle(self, msg_type, flags, payload):
+        """ (response type, packed payload) replies to one message, after applying it """
+        replies = []
+        if flags & ACK_REQUESTED:
+            replies.append((Acknowledgement, b""))
+        handler = HANDLERS.get(msg_type)
+        if handler is not None:
+            method, is_get = handler
+            states = method(self, payload)
+            if is_get or flags & RESPONSE_REQUESTED:
+                replies.extend(states)
+        return replies
+
+    def get_service(self, payload):
+        return [(StateService, SERVICE.pack(SERVICE_UDP, self.port))]
+
+    def get_host_firmware(self, payload):
+        return [(StateHostFirmware, FIRMWARE.pack(0, 0, FIRMWARE_VERSION))]
+
+    def get_wifi_firmware(self, payload):
+        return [(StateWifiFirmware, FIRMWARE.pack(0, 0, FIRMWARE_VERSION))]
+
+    def get_wifi_info(self, payload):
+        return [(StateWifiInfo, WIFI_INFO.pack(self.signal_mw, 0, 0, 0))]
+
+    def get_version(self, payload):
+        return [(StateVersion, VERSION.pack(1, self.product, 0))]
+
+    def get_info(self, payload):
+        now = time()
+        return [(StateInfo, INFO.pack(int(now * 1e9), int((now - self.started_at) * 1e9), 0))]
+
+    def get_power(self, payload):
+        return [(StatePower, POWER.pack(self.power_level))]
+
+    def set_power(self, payload):
+        self.power_level, = POWER.unpack_from(payload)
+        return self.get_power(payload)
+
+    def get_label(self, payload):
+        return [(StateLabel, encode_label(self.label))]
+
+    def set_label(self, payload):
+        self.label = decode_label(payload)
+        return self.get_label(payload)
+
+    def get_group(self, payload):
+        return [(StateGroup, GROUP.pack(bytes(16), encode_label(self.group), 0))]
+
+    def get_location(self, payload):
+        return [(StateLocation, GROUP.pack(bytes(16), encode_label(self.location), 0))]
+
+    def light_get(self, payload):
+        return [(LightState, LIGHT_STATE.pack(*self.color, 0, self.power_level, encode_label(self.label), 0))]
+
+    def light_set_color(self, payload):
+        self.color = COLOR.unpack_from(payload)[:4]
+        return self.light_get(payload)
+
+    def light_set_waveform(self, payload):
+        transient, hue, saturation, brightness, kelvin = WAVEFORM.unpack_from(payload)[:5]
+        if not transient:  # a transient waveform returns to the original color
+            self.color = (hue, saturation, brightness, kelvin)
+        return self.light_get(payload)
+
+    def light_get_power(self, payload):
+        return [(LightStatePower, POWER.pack(self.power_level))]
+
+    def light_set_power(self, payload):
+        self.power_level = LIGHT_POWER.unpack_from(payload)[0]
+        return self.light_get_power(payload)
+
+    def get_extended_color_zones(self, payload):
+        zone_count = len(self.zones) // HSBK_SIZE
+        states = []
+        for index in range(0, zone_count, EXTENDED_ZONE_COUNT):
+            count = min(EXTENDED_ZONE_COUNT, zone_count - index)
+            colors = bytes(self.zones[index * HSBK_SIZE:(index + count) * HSBK_SIZE]).ljust(EXTENDED_ZONE_COUNT * HSBK_SIZE, b"\0")
+            states.append((MultiZoneStateExtendedColorZones, EXTENDED_ZONES_STATE.pack(zone_count, index, count) + colors))
+        return states
+
+    def set_extended_color_zones(self, payload):
+        duration, apply, index, count = EXTENDED_COLOR_ZONES.unpack_from(payload)
+        colors = payload[EXTENDED_COLOR_ZONES.size:EXTENDED_COLOR_ZONES.size + count * HSBK_SIZE]
+        start = index * HSBK_SIZE
+        colors = colors[:max(0, len(self.zones) - start)]  # zones past the end of the strip don't exist
+        self.zones[start:start + len(colors)] = colors
+        return self.get_extended_color_zones(payload)
+
+    def tile_states(self, tile_index, length, x, y, width):
+        return [(StateTileState64, TILE_STATE_64.pack(i, x, y, width) + bytes(self.tiles[i]))
+                for i in range(tile_index, min(tile_index + length, len(self.tiles)))]
+
+    def get_tile_state_64(self, payload):
+        return self.tile_states(*GET_TILE_STATE_64.unpack_from(payload))
+
+    def set_tile_state_64(self, payload):
+        tile_index, length, x, y, width, duration = SET_TILE_STATE_64.unpack_from(payload)
+        colors = payload[SET_TILE_STATE_64.size:SET_TILE_STATE_64.size + TILE_ZONE_COUNT * HSBK_SIZE]
+        for i in range(tile_index, min(tile_index + length, len(self.tiles))):
+            self.tiles[i][:len(colors)] = colors
+        return self.tile_states(tile_index, length, x, y, width)
+
+
+# message type -> (VirtualBulb method, whether it is a Get that is always answered)
+HANDLERS = {
+    GetService: (VirtualBulb.get_service, True),
+    GetHostFirmware: (VirtualBulb.get_host_firmware, True),
+    GetWifiFirmware: (VirtualBulb.get_wifi_firmware, True),
+    GetWifiInfo: (VirtualBulb.get_wifi_info, True),
+    GetVersion: (VirtualBulb.get_version, True),
+    GetInfo: (VirtualBulb.get_info, True),
+    GetPower: (VirtualBulb.get_power, True),
+    SetPower: (VirtualBulb.set_power, False),
+    GetLabel: (VirtualBulb.get_label, True),
+    SetLabel: (VirtualBulb.set_label, False),
+    GetGroup: (VirtualBulb.get_group, True),
+    GetLocation: (VirtualBulb.get_location, True),
+    LightGet: (VirtualBulb.light_get, True),
+    LightSetColor: (VirtualBulb.light_set_color, False),
+    LightSetWaveform: (VirtualBulb.light_set_waveform, False),
+    LightGetPower: (VirtualBulb.light_get_power, True),
+    LightSetPower: (VirtualBulb.light_set_power, False),
+    MultiZoneGetExtendedColorZones: (VirtualBulb.get_extended_color_zones, True),
+    MultiZoneSetExtendedColorZones: (VirtualBulb.set_extended_color_zones, False),
+    GetTileState64: (VirtualBulb.get_tile_state_64, True),
+    SetTileState64: (VirtualBulb.set_tile_state_64, False),
+}
+MSG_TYPES = {msg_id: msg_type for msg_type, msg_id in MSG_IDS.items()}
+
+
+def make_bulbs(count, multizone_count=0, tile_count=0, zone_count=DEFAULT_ZONE_COUNT, tiles_per_chain=DEFAULT_TILE_COUNT,
+               groups=3, rate_limit=DEFAULT_RATE_LIMIT):
+    """ count color bulbs, then multizone_count strips of zone_count zones and tile_count chains of tiles_per_chain tiles """
+    bulbs = []
+    for i in range(count + multizone_count + tile_count):
+        if i < count:
+            kwargs = {"product": COLOR_PRODUCT}
+        elif i < count + multizone_count:
+            kwargs = {"product": MULTIZONE_PRODUCT, "zone_count": zone_count}
+        else:
+            kwargs = {"product": TILE_PRODUCT, "tile_count": tiles_per_chain}
+        mac_addr = "d0:73:d5:{:02x}:{:02x}:{:02x}".format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+        bulbs.append(VirtualBulb(mac_addr, "bulb{}".format(i), "group{}".format(i % groups), "home", rate_limit=rate_limit, **kwargs))
+    return bulbs
+
+
+class SimulatedFleet(asyncio.DatagramProtocol):
+    """ Virtual bulbs behind one UDP endpoint, answering broadcasts and unicasts like a LAN of LIFX devices
+
+    Replies are delayed by latency (plus up to jitter) seconds, and each packet,
+    in either direction, is lost with probability loss. stats counts what
+    happened to the traffic.
+    """
+    def __init__(self, bulbs, latency=0.0, jitter=0.0, loss=0.0, seed=None):
+        self.bulbs = {bulb.mac_addr: bulb for bulb in bulbs}
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.transport = None
+        self.port = None
+        self.stats = {"received": 0, "sent": 0, "lost": 0, "rate_limited": 0}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.port = transport.get_extra_info("sockname")[1]
+        for bulb in self.bulbs.values():
+            bulb.port = self.port
+
+    def lost(self):
+        if self.loss and self.random.random() < self.loss:
+            self.stats["lost"] += 1
+            return True
+        return False
+
+    def datagram_received(self, data, addr):
+        try:
+            source_id, target_addr, seq_num, msg_id = peek_header(data)
+        except struct.error:
+            return
+        self.stats["received"] += 1
+        if self.lost():
+            return
+        msg_type = MSG_TYPES.get(msg_id)
+        flags = data[FLAGS_OFFSET]
+        payload = data[HEADER_SIZE_BYTES:]
+        if target_addr == BROADCAST_MAC:
+            bulbs = self.bulbs.values()
+        else:
+            bulbs = [self.bulbs[target_addr]] if target_addr in self.bulbs else []
+        loop = asyncio.get_running_loop()
+        for bulb in bulbs:
+            if not bulb.admit():
+                self.stats["rate_limited"] += 1
+                continue
+            replies = bulb.handle(msg_type, flags, payload)
+            if replies:
+                delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+                loop.call_later(delay, self.reply, bulb, source_id, seq_num, replies, addr)
+
+    def reply(self, bulb, source_id, seq_num, replies, addr):
+        if self.transport is None:
+            return
+        for msg_type, payload in replies:
+            if self.lost():
+                continue
+            self.transport.sendto(bulb.encode(msg_type, source_id, seq_num, payload), addr)
+            self.stats["sent"] += 1
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = None
+
+
+async def start_fleet(bulbs, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, loss=0.0, seed=None):
+    """ Serve bulbs on host:port (port 0: any free port, see fleet.port); returns the SimulatedFleet """
+    loop = asyncio.get_running_loop()
+    transport, fleet = await loop.create_datagram_endpoint(
+        lambda: SimulatedFleet(bulbs, latency, jitter, loss, seed),
+        local_addr=(host, port))
+    return fleet
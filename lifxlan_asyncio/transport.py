@@ -0,0 +1,330 @@
+import asyncio
+import logging
+import struct
+from socket import SOL_SOCKET, SO_RCVBUF
+
+from lifxlan import WorkflowException
+from lifxlan.message import BROADCAST_MAC
+from lifxlan.msgtypes import MSG_IDS
+
+from lifxlan_asyncio.codec import peek_header, unpack_message
+from lifxlan_asyncio.interfaces import find_interface
+from lifxlan_asyncio.metrics import Metrics
+from lifxlan_asyncio.ratelimit import DEFAULT_BURST, DEFAULT_RATE_LIMIT, SendScheduler
+
+# Every device answers a broadcast at once; the default buffer overflows at a few hundred replies
+RECEIVE_BUFFER_BYTES = 1 << 20
+
+
+class LifxProtocol(asyncio.DatagramProtocol):
+    """ Datagram protocol that decodes incoming LIFX packets and hands them to the transport """
+    def __init__(self, owner):
+        self.owner = owner
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.owner.dispatch(data, addr)
+
+    def error_received(self, exc):
+        logging.warning("LIFX transport error: {}".format(exc))
+
+
+class ListenerProtocol(LifxProtocol):
+    """ Protocol of the shared LIFX port: only observers see what arrives there, never a request's subscription """
+    def datagram_received(self, data, addr):
+        self.owner.dispatch(data, addr, observe_only=True)
+
+
+class Subscription:
+    """ Queue of responses to one outstanding request, keyed by (target MAC, sequence number, source id) """
+    def __init__(self, transport, key, responses=None):
+        self.transport = transport
+        self.key = key
+        # several subscriptions may share one queue to be awaited together
+        self.responses = responses if responses is not None else asyncio.Queue()
+
+    async def recv(self, timeout_secs):
+        """ Wait up to timeout_secs for the next response, raising asyncio.TimeoutError if none arrives """
+        return await asyncio.wait_for(self.responses.get(), timeout_secs)
+
+    def close(self):
+        if self.transport.subscriptions.get(self.key) is self:
+            del self.transport.subscriptions[self.key]
+            self.transport.release_seq_num(self.key[0], self.key[1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class AsyncTransport:
+    """ Long-lived, non-blocking UDP endpoint shared by every request of a client
+
+    Outgoing messages get a rolling per-target sequence number, and incoming
+    packets are routed to the Subscription registered for their
+    (target MAC, sequence number, source id), so any number of requests can be
+    in flight over the one socket. Sends are paced per destination by a
+    SendScheduler (rate_limit=None disables pacing).
+
+    With open_interfaces() it also binds one endpoint per network interface,
+    and each packet leaves through the endpoint on its destination's subnet
+    (the wildcard endpoint for anything else). Replies to every endpoint go
+    through the same dispatch.
+
+    Packet counts and request outcomes are kept in metrics (see Metrics).
+    """
+    def __init__(self, loop=None, verbose=False, rate_limit=DEFAULT_RATE_LIMIT, burst=DEFAULT_BURST, metrics=None):
+        self.given_loop = loop  # None: whichever loop is running when the transport opens
+        self.loop = loop
+        self.verbose = verbose
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.scheduler = SendScheduler(rate_limit, burst)
+        self.transport = None
+        self.protocol = None
+        self.listener = None  # endpoint on the LIFX port itself, see listen()
+        self.interfaces = []  # Interfaces with an endpoint of their own
+        self.endpoints = {}   # interface ip_addr -> datagram transport bound to it
+        self.routes = {}      # destination ip_addr -> datagram transport to send from
+        self.seq_nums = {}
+        self.seq_nums_in_use = {}  # target -> sequence numbers of its live subscriptions
+        self.seq_num_waiters = {}  # target -> futures of requests waiting for one of those to be released
+        self.subscriptions = {}
+        self.device_addrs = {}       # device MAC -> ip_addr it last answered a request from
+        self.broadcast_domains = {}  # broadcast ip_addr -> MACs of the known devices it reaches
+        # (callable, message type ids) pairs, e.g. DeviceRegistry.observe
+        self.observers = []
+        self.observed_msg_ids = set()
+
+    async def open(self):
+        if self.transport is not None:
+            if self.given_loop is not None or self.loop is asyncio.get_running_loop():
+                return self
+            self.close()  # opened under a loop that is gone (e.g. a previous asyncio.run), start over under this one
+        self.loop = self.given_loop if self.given_loop is not None else asyncio.get_running_loop()
+        self.transport, self.protocol = await self.create_endpoint("0.0.0.0")
+        return self
+
+    async def create_endpoint(self, ip_addr, port=0, protocol_factory=LifxProtocol, reuse_port=None):
+        try:
+            transport, protocol = await self.loop.create_datagram_endpoint(
+                lambda: protocol_factory(self),
+                local_addr=(ip_addr, port),  # port 0: allow OS to assign next available source port
+                allow_broadcast=True,
+                reuse_port=reuse_port)
+        except OSError as err:
+            raise WorkflowException("WorkflowException: error {} while trying to open socket".format(str(err)))
+        try:
+            transport.get_extra_info("socket").setsockopt(SOL_SOCKET, SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+        except OSError:
+            pass  # capped by the OS, keep its default
+        return transport, protocol
+
+    async def open_interfaces(self, interfaces):
+        """ Have one endpoint per interface, closing those of interfaces that went away """
+        await self.open()
+        for interface in interfaces:
+            if interface.ip_addr in self.endpoints:
+                continue
+            try:
+                self.endpoints[interface.ip_addr], _ = await self.create_endpoint(interface.ip_addr)
+            except WorkflowException as e:
+                logging.warning("Not binding to {} ({}), its traffic will use the default endpoint: {}".format(interface.name, interface.ip_addr, e))
+        current = {interface.ip_addr for interface in interfaces}
+        for ip_addr in list(self.endpoints):
+            if ip_addr not in current:
+                self.endpoints.pop(ip_addr).close()
+        self.interfaces = [interface for interface in interfaces if interface.ip_addr in self.endpoints]
+        self.routes.clear()
+        self.broadcast_domains.clear()
+        return self
+
+    async def listen(self, port):
+        """ Also receive on the LIFX port, shared with other LIFX apps, to observe state broadcast to it """
+        await self.open()
+        if self.listener is None:
+            self.listener, _ = await self.create_endpoint("0.0.0.0", port, ListenerProtocol, reuse_port=True)
+        return self
+
+    def interface_for(self, ip_addr):
+        """ The Interface on ip_addr's subnet, None when it is only reachable through the default endpoint """
+        return find_interface(self.interfaces, ip_addr)
+
+    def endpoint_for(self, ip_addr):
+        endpoint = self.routes.get(ip_addr)
+        if endpoint is None:
+            interface = self.interface_for(ip_addr)
+            endpoint = self.endpoints[interface.ip_addr] if interface is not None else self.transport
+            self.routes[ip_addr] = endpoint
+        return endpoint
+
+    def devices_reached_by(self, broadcast_addr):
+        """ MACs of the known devices on broadcast_addr's subnet
+
+        A broadcast address of no bound interface (e.g. 255.255.255.255) goes out
+        of the default endpoint, reaching the devices on no bound interface's subnet.
+        """
+        mac_addrs = self.broadcast_domains.get(broadcast_addr)
+        if mac_addrs is None:
+            interface = self.interface_for(broadcast_addr)
+            mac_addrs = [mac_addr for mac_addr, ip_addr in self.device_addrs.items() if self.interface_for(ip_addr) == interface]
+            self.broadcast_domains[broadcast_addr] = mac_addrs
+        return mac_addrs
+
+    def next_seq_num(self, target_addr):
+        """ Next sequence number for target_addr, skipping those still awaiting replies
+
+        Falls back to a number in use when all 256 are; fine for messages that
+        ask for no reply, requests that do should use acquire_seq_num().
+        """
+        in_use = self.seq_nums_in_use.get(target_addr, ())
+        seq_num = self.seq_nums.get(target_addr, -1)
+        for _ in range(256):
+            seq_num = (seq_num + 1) & 0xff
+            if seq_num not in in_use:
+                break
+        self.seq_nums[target_addr] = seq_num
+        return seq_num
+
+    async def acquire_seq_num(self, target_addr):
+        """ A sequence number no live subscription to target_addr uses, waiting for one if all 256 are
+
+        Subscribe with it before awaiting anything else, or another request may take it.
+        """
+        while len(self.seq_nums_in_use.get(target_addr, ())) >= 256:
+            waiter = asyncio.get_running_loop().create_future()
+            self.seq_num_waiters.setdefault(target_addr, []).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                self.wake_seq_num_waiter(target_addr)  # pass on a release this waiter may have been woken for
+                raise
+        return self.next_seq_num(target_addr)
+
+    def subscribe(self, target_addr, seq_num, source_id, responses=None):
+        key = (target_addr, seq_num, source_id)
+        if key in self.subscriptions:
+            raise WorkflowException("WorkflowException: sequence number {} to {} is still awaiting replies".format(seq_num, target_addr))
+        subscription = Subscription(self, key, responses)
+        self.subscriptions[key] = subscription
+        self.seq_nums_in_use.setdefault(target_addr, set()).add(seq_num)
+        return subscription
+
+    def release_seq_num(self, target_addr, seq_num):
+        in_use = self.seq_nums_in_use.get(target_addr)
+        if in_use is not None:
+            in_use.discard(seq_num)
+            if not in_use:
+                del self.seq_nums_in_use[target_addr]
+        self.wake_seq_num_waiter(target_addr)
+
+    def wake_seq_num_waiter(self, target_addr):
+        waiters = self.seq_num_waiters.get(target_addr)
+        while waiters:
+            waiter = waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        if not waiters:
+            self.seq_num_waiters.pop(target_addr, None)
+
+    def add_observer(self, observer, msg_types):
+        """ Have observer(response, addr) called with every decoded packet of the given types """
+        msg_ids = {MSG_IDS[msg_type] for msg_type in msg_types}
+        self.observers.append((observer, msg_ids))
+        self.observed_msg_ids |= msg_ids
+
+    def dispatch(self, data, addr, observe_only=False):
+        # Peek at the header first so packets nobody is waiting for are dropped without being decoded
+        try:
+            source_id, target_addr, seq_num, msg_id = peek_header(data)
+        except struct.error:
+            self.metrics.dropped += 1
+            return  # too short to be a LIFX packet
+        metrics = self.metrics
+        metrics.received += 1
+        if target_addr != BROADCAST_MAC:
+            metrics.device(target_addr).received += 1
+        subscription = None
+        if not observe_only:
+            # unicast requests are keyed by the device MAC, broadcast requests collect from every device;
+            # clients broadcast under a source id of their own, so a reply matches one or the other
+            subscription = self.subscriptions.get((target_addr, seq_num, source_id))
+            if subscription is None and target_addr != BROADCAST_MAC:
+                subscription = self.subscriptions.get((BROADCAST_MAC, seq_num, source_id))
+        if subscription is None and msg_id not in self.observed_msg_ids:
+            if not observe_only:
+                metrics.dropped += 1
+            return
+        try:
+            response = unpack_message(data, msg_id)
+        except Exception:
+            # malformed packet, nothing is waiting for it
+            metrics.dropped += 1
+            return
+        response.ip_addr = addr[0]
+        if subscription is not None and target_addr != BROADCAST_MAC and self.device_addrs.get(target_addr) != addr[0]:
+            if target_addr not in self.device_addrs and subscription.key[0] == BROADCAST_MAC:
+                self.scheduler.charge(target_addr)  # the broadcast it answers went out before the device was known
+            self.device_addrs[target_addr] = addr[0]
+            self.broadcast_domains.clear()
+        if self.verbose:
+            print("RECV: " + str(response))
+        for observer, msg_ids in self.observers:
+            if msg_id in msg_ids:
+                observer(response, addr)
+        if subscription is not None:
+            subscription.responses.put_nowait((response, addr))
+
+    async def sendto(self, msg, addr):
+        # unicast is paced per device, broadcast per broadcast domain; every device a broadcast
+        # reaches has to take it in too, so it counts against their budgets as well
+        if msg.target_addr == BROADCAST_MAC:
+            await self.scheduler.acquire_all([addr[0]] + self.devices_reached_by(addr[0]))
+        else:
+            await self.scheduler.acquire(msg.target_addr)
+        self.sendto_nowait(msg, addr)
+
+    def sendto_nowait(self, msg, addr):
+        """ Send immediately; for callers that already took their turn from the scheduler """
+        self.endpoint_for(addr[0]).sendto(msg.packed_message, addr)
+        metrics = self.metrics
+        metrics.sent += 1
+        if msg.target_addr != BROADCAST_MAC:
+            metrics.device(msg.target_addr).sent += 1
+        if self.verbose:
+            print("SEND: " + str(msg))
+
+    def close(self):
+        endpoints = [self.transport, self.listener] + list(self.endpoints.values())
+        for endpoint in endpoints:
+            if endpoint is None:
+                continue
+            if self.loop is not None and self.loop.is_closed():
+                break  # e.g. closing after asyncio.run() returned: nothing can run the close, the sockets go with the endpoints
+            endpoint.close()
+        self.transport = None
+        self.protocol = None
+        self.listener = None
+        self.loop = self.given_loop  # reopened under whichever loop runs then
+        self.interfaces = []
+        self.endpoints.clear()
+        self.routes.clear()
+        self.broadcast_domains.clear()
+        self.subscriptions.clear()
+        self.seq_nums_in_use.clear()
+        for waiters in self.seq_num_waiters.values():
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.cancel()
+        self.seq_num_waiters.clear()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
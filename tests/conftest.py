@@ -0,0 +1,17 @@
+from contextlib import asynccontextmanager
+
+from lifxlan_asyncio.lifxlan_asyncio import AsyncLifxLAN
+from lifxlan_asyncio.simulator import start_fleet
+
+
+@asynccontextmanager
+async def simulated_lan(bulbs, latency=0.0, loss=0.0, seed=None, **kwargs):
+    """ (fleet, lan): the bulbs simulated on localhost, and an AsyncLifxLAN broadcasting to them """
+    fleet = await start_fleet(bulbs, latency=latency, loss=loss, seed=seed)
+    lan = AsyncLifxLAN(num_lights=len(bulbs), broadcast_addrs=["127.0.0.1"], broadcast_port=fleet.port, **kwargs)
+    try:
+        yield fleet, lan
+    finally:
+        lan.close()
+        fleet.close()
+
@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from lifxlan_asyncio import animation
+from lifxlan_asyncio.animation import Animation, pulse, rainbow, render_frames
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_render_frames_with_and_without_numpy(monkeypatch):
+    for effect in (rainbow(period=1), pulse([100, 65535, 65535, 3500], period=0.5, spread=0.5)):
+        frames = render_frames(effect, 3, 10, fps=10)
+        assert frames.shape == (10, 3, 4)
+        assert frames[0, 0].tolist() == list(map(round, effect(0, 0, 3)))
+        with monkeypatch.context() as m:
+            m.setattr(animation, "numpy", None)
+            m.setattr(animation, "sin", animation.math.sin)
+            flat = render_frames(effect, 3, 10, fps=10)
+        assert flat.typecode == "H"
+        assert flat.tolist() == frames.ravel().tolist()
+
+
+def test_last_frame_reaches_every_light():
+    async def main():
+        async with simulated_lan(make_bulbs(3, rate_limit=None), rate_limit=None) as (fleet, lan):
+            lights = await lan.get_lights()
+            show = Animation(lights, rainbow(period=1), duration=0.25, fps=20)
+            assert await show.play() == 0
+            await asyncio.sleep(0.05)
+            for index, light in enumerate(lights):
+                assert fleet.bulbs[light.mac_addr].color == tuple(show.frames[-1, index].tolist())
+    asyncio.run(main())
+
+
+def test_play_drops_frames_to_keep_time():
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), rate_limit=None) as (fleet, lan):
+            lights = await lan.get_lights()
+            show = Animation(lights, rainbow(), duration=0.5, fps=20)
+            played = []
+            send_frame = show.send_frame
+
+            def slow_send_frame(transport, frame):
+                played.append(frame)
+                send_frame(transport, frame)
+                if frame == 2:
+                    time.sleep(0.2)  # the loop stalls for four ticks
+
+            show.send_frame = slow_send_frame
+            dropped = await show.play()
+            assert dropped >= 3
+            assert len(played) + dropped == show.num_frames
+            assert played[:3] == [0, 1, 2] and played == sorted(played) and played[-1] == show.num_frames - 1
+    asyncio.run(main())
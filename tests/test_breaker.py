@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+from lifxlan.errors import WorkflowException
+from lifxlan.msgtypes import GetPower, StatePower
+
+from lifxlan_asyncio.breaker import CircuitBreaker, CircuitOpenException
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_opens_after_threshold_failures_and_closes_on_success():
+    breaker = CircuitBreaker(threshold=2, probe_interval=60)
+    assert not breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    breaker.next_probe = 0
+    assert breaker.allow()      # the probe
+    assert not breaker.allow()  # only one per interval
+    breaker.record_success()
+    assert not breaker.is_open and breaker.allow()
+
+
+def test_device_circuit():
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), rate_limit=None) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            light.breaker.probe_interval = 0.2
+            fleet.loss = 1.0
+            for _ in range(light.breaker.threshold):
+                with pytest.raises(WorkflowException):
+                    await light.req_with_resp(GetPower, StatePower, timeout_secs=0.05, max_attempts=1)
+            assert light.breaker.is_open
+            with pytest.raises(CircuitOpenException):
+                await light.get_power(max_age=0)
+            assert light.probe_task is not None
+            # the device comes back and answers the next probe, one packet
+            fleet.loss = 0.0
+            sent = lan.metrics.sent
+            await asyncio.wait_for(light.probe_task, 2)
+            assert not light.breaker.is_open
+            assert lan.metrics.sent == sent + 1
+            assert await light.get_power(max_age=0) == 0
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+import asyncio
+
+from lifxlan.msgtypes import LightState, SetPower, StateLabel, StatePower, StateVersion
+
+from lifxlan_asyncio import cache
+from lifxlan_asyncio.cache import MISSING, StateCache
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def response(response_type, payload):
+    return response_type("d0:73:d5:00:00:01", 1, 0, payload)
+
+
+def test_ttls(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache, "monotonic", lambda: now[0])
+    state_cache = StateCache({StateLabel: 10})
+    power = response(StatePower, {"power_level": 65535})
+    label = response(StateLabel, {"label": "bulb"})
+    version = response(StateVersion, {"vendor": 1, "product": 22, "version": 0})
+    for r in (power, label, version):
+        state_cache.put(r)
+    now[0] += 0.5
+    assert state_cache.get(StatePower) is power
+    assert state_cache.get(StatePower, max_age=0) is MISSING
+    now[0] += 1
+    assert state_cache.get(StatePower) is MISSING  # default TTL of 1 s
+    assert state_cache.get(StateLabel) is label    # TTL overridden to 10 s
+    now[0] += 10
+    assert state_cache.get(StateLabel) is MISSING
+    assert state_cache.get(StateVersion) is version  # never goes stale
+    assert state_cache.get(LightState) is MISSING
+
+
+def test_set_invalidates_what_it_changes():
+    state_cache = StateCache()
+    label = response(StateLabel, {"label": "bulb"})
+    state_cache.put(response(StatePower, {"power_level": 0}))
+    state_cache.put(label)
+    state_cache.invalidate(SetPower)
+    assert state_cache.get(StatePower) is MISSING
+    assert state_cache.get(StateLabel) is label
+
+
+def test_gets_are_served_from_the_cache_until_a_set():
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), rate_limit=None) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            assert await light.get_power(max_age=0) == 0
+            received = fleet.stats["received"]
+            assert await light.get_power() == 0
+            assert fleet.stats["received"] == received
+            await light.set_power("on")
+            assert await light.get_power() == 65535
+            assert fleet.stats["received"] == received + 2
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+import asyncio
+import struct
+
+import pytest
+from lifxlan.msgtypes import LightSetColor, LightSetPower, LightSetWaveform, SetPower
+
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def set_color(light, color):
+    return light.fire_and_forget(LightSetColor, {"color": color, "duration": 0}, num_repeats=1)
+
+
+async def use_up_burst(light):
+    # so the Sets that follow have to queue for a send slot
+    for i in range(8):
+        await set_color(light, [i, 0, 0, 3500])
+
+
+def test_latest_set_wins():
+    async def main():
+        async with simulated_lan(make_bulbs(1)) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            await use_up_burst(light)
+            received = fleet.stats["received"]
+            await asyncio.gather(*(set_color(light, [hue, 0, 0, 3500]) for hue in range(100, 110)))
+            await asyncio.sleep(0.1)
+            assert fleet.bulbs[light.mac_addr].color == (109, 0, 0, 3500)
+            assert fleet.stats["received"] - received < 10
+            assert fleet.stats["rate_limited"] == 0
+    asyncio.run(main())
+
+
+def test_cancelled_caller():
+    async def main():
+        async with simulated_lan(make_bulbs(1)) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            await use_up_burst(light)
+            try:
+                await asyncio.wait_for(set_color(light, [1, 1, 1, 3500]), 0.001)
+            except asyncio.TimeoutError:
+                pass
+            # supersedes the cancelled caller's Set, which must not break the queue
+            await asyncio.wait_for(set_color(light, [2, 2, 2, 3500]), 1)
+            await asyncio.sleep(0.05)
+            assert fleet.bulbs[light.mac_addr].color == (2, 2, 2, 3500)
+            assert light.outbound == {}
+            assert light.outbound_task.done() and light.outbound_task.exception() is None
+    asyncio.run(main())
+
+
+def test_bad_payload_fails_its_caller():
+    async def main():
+        async with simulated_lan(make_bulbs(1)) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            await use_up_burst(light)
+            with pytest.raises(struct.error):
+                await asyncio.wait_for(set_color(light, [70000, 0, 0, 3500]), 1)
+            await asyncio.wait_for(set_color(light, [3, 3, 3, 3500]), 1)
+            await asyncio.sleep(0.05)
+            assert fleet.bulbs[light.mac_addr].color == (3, 3, 3, 3500)
+            assert light.outbound_task.exception() is None
+    asyncio.run(main())
+
+
+def test_sets_of_the_same_state_replace_each_other():
+    async def main():
+        async with simulated_lan(make_bulbs(1)) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            await use_up_burst(light)
+            waveform = {"transient": 0, "color": [500, 0, 0, 3500], "period": 0, "cycles": 1, "duty_cycle": 0, "waveform": 0}
+            await asyncio.gather(
+                set_color(light, [100, 0, 0, 3500]),
+                light.fire_and_forget(LightSetWaveform, waveform, num_repeats=1),
+                set_color(light, [999, 0, 0, 3500]),
+                light.fire_and_forget(LightSetPower, {"power_level": 65535, "duration": 0}, num_repeats=1),
+                light.fire_and_forget(SetPower, {"power_level": 0}, num_repeats=1))
+            await asyncio.sleep(0.1)
+            bulb = fleet.bulbs[light.mac_addr]
+            assert (bulb.color, bulb.power_level) == ((999, 0, 0, 3500), 0)
+    asyncio.run(main())
+
+
+def test_rapid_batch_replaces_queued_sets():
+    async def main():
+        async with simulated_lan(make_bulbs(1)) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            await use_up_burst(light)
+            stale = asyncio.ensure_future(set_color(light, [100, 0, 0, 3500]))
+            await asyncio.sleep(0)
+            await lan.set_colors({light: [200, 0, 0, 3500]}, rapid=True)
+            await stale
+            await asyncio.sleep(0.1)
+            assert fleet.bulbs[light.mac_addr].color == (200, 0, 0, 3500)
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+from array import array
+
+import pytest
+from lifxlan.message import BROADCAST_MAC
+from lifxlan.msgtypes import GetService, LightGet, LightSetColor, LightSetInfrared, LightSetPower, LightSetWaveform, \
+    MultiZoneSetColorZones, SetLabel, SetPower, StatePower
+
+from lifxlan_asyncio.codec import PacketTemplate, pack_colors, peek_header, split_colors, unpack_message
+
+MAC = "d0:73:d5:12:34:56"
+SOURCE_ID = 0x12345678
+
+MESSAGES = [
+    (GetService, {}),
+    (LightGet, {}),
+    (SetPower, {"power_level": 65535}),
+    (LightSetPower, {"power_level": 0, "duration": 1500}),
+    (LightSetColor, {"color": [65535, 32768, 1, 9000], "duration": 250}),
+    (LightSetWaveform, {"transient": 1, "color": [21845, 65535, 65535, 3500], "period": 1000, "cycles": 2.5,
+                        "duty_cycle": -8192, "waveform": 3}),
+    (LightSetInfrared, {"infrared_brightness": 30000}),
+    (SetLabel, {"label": "Kitchen"}),
+    (MultiZoneSetColorZones, {"start_index": 2, "end_index": 5, "color": [1, 2, 3, 3500], "duration": 0, "apply": 1}),
+]
+
+
+@pytest.mark.parametrize("target_addr, msg_type, payload", [
+    (target_addr, msg_type, payload) for target_addr in (MAC, BROADCAST_MAC) for msg_type, payload in MESSAGES
+    if target_addr == BROADCAST_MAC or msg_type != GetService])  # lifxlan always broadcasts GetService
+@pytest.mark.parametrize("ack_requested, response_requested", [(False, False), (True, False), (False, True), (True, True)])
+def test_encode_is_byte_identical_to_lifxlan(target_addr, msg_type, payload, ack_requested, response_requested):
+    template = PacketTemplate(target_addr, SOURCE_ID)
+    for seq_num in (0, 1, 255):
+        packet = template.encode(msg_type, seq_num, payload, ack_requested, response_requested)
+        expected = msg_type(target_addr, SOURCE_ID, seq_num, payload, ack_requested, response_requested).packed_message
+        assert bytes(packet.packed_message) == expected
+
+
+def test_label_is_32_bytes_however_it_encodes():
+    # lifxlan pads to 32 characters rather than bytes, making a non-ASCII label's packet too long
+    packet = PacketTemplate(MAC, SOURCE_ID).encode(SetLabel, 0, {"label": "Küche"})
+    assert bytes(packet.packed_message[36:]) == "Küche".encode("utf-8").ljust(32, b"\0")
+
+
+def test_peek_and_unpack():
+    data = bytes(PacketTemplate(MAC, SOURCE_ID).encode(StatePower, 9, {"power_level": 65535}).packed_message)
+    assert peek_header(data) == (SOURCE_ID, MAC, 9, StatePower(MAC, 0, 0, {"power_level": 0}).message_type)
+    response = unpack_message(data, peek_header(data)[3])
+    assert type(response) == StatePower
+    assert response.power_level == 65535
+
+
+def test_pack_colors():
+    colors = [[1, 2, 3, 3500], [65535, 0, 65535, 9000]]
+    expected = bytes.fromhex("010002000300ac0dffff0000ffff2823")
+    assert pack_colors(colors) == expected
+    assert pack_colors(array("H", [1, 2, 3, 3500, 65535, 0, 65535, 9000])) == expected
+    numpy = pytest.importorskip("numpy")
+    assert pack_colors(numpy.array(colors)) == expected
+
+
+def test_split_colors_pads_the_last_chunk():
+    chunks = list(split_colors(pack_colors([[i, 0, 0, 3500] for i in range(5)]), 2))
+    assert [(index, count) for index, count, _ in chunks] == [(0, 2), (2, 2), (4, 1)]
+    assert all(len(chunk) == 16 for _, _, chunk in chunks)
+    assert chunks[-1][2][8:] == bytes(8)
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+from lifxlan.errors import WorkflowException
+from lifxlan.msgtypes import LightGet, LightSetColor, LightState, SetPower, StatePower
+
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_ack_and_state_from_one_request():
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), rate_limit=None) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            sent = lan.metrics.sent
+            state = await light.req_with_ack_resp(LightSetColor, LightState, {"color": [1, 2, 3, 3500], "duration": 0})
+            assert tuple(state.color) == (1, 2, 3, 3500)
+            assert lan.metrics.sent == sent + 1
+            assert await light.req_with_cached_resp(LightGet, LightState) is state  # cached from the reply, no Get sent
+            assert lan.metrics.sent == sent + 1
+    asyncio.run(main())
+
+
+def test_ack_without_state_fails():
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), rate_limit=None) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            bulb = fleet.bulbs[light.mac_addr]
+            handle = bulb.handle
+            bulb.handle = lambda msg_type, flags, payload: handle(msg_type, flags, payload)[:1]  # just the ack
+            with pytest.raises(WorkflowException):
+                await light.req_with_ack_resp(SetPower, StatePower, {"power_level": 65535}, timeout_secs=0.05, max_attempts=2)
+            assert lan.metrics.device(light.mac_addr).timeouts == 1
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+import asyncio
+
+from lifxlan.msgtypes import LightGet, LightState
+
+from lifxlan_asyncio.events import StateEvent, StateTracker
+from lifxlan_asyncio.registry import DeviceRegistry
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_events_follow_state_packets():
+    async def main():
+        async with simulated_lan(make_bulbs(2, rate_limit=None), rate_limit=None) as (fleet, lan):
+            lights = await lan.get_lights()
+            events = lan.events()
+            next_event = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(0.05)  # subscribed
+
+            assert await lan.get_power_all_lights()
+            received = [await next_event]
+            received.append(await asyncio.wait_for(events.__anext__(), 1))
+            assert sorted(received, key=lambda e: e.device.mac_addr) == [StateEvent(light, "power_level", 0, None) for light in lights]
+
+            bulb = fleet.bulbs[lights[0].mac_addr]
+            bulb.power_level, bulb.color = 65535, (1, 2, 3, 3500)
+            await lights[0].req_with_resp(LightGet, LightState)
+            received = [await asyncio.wait_for(events.__anext__(), 1) for _ in range(2)]
+            assert received == [StateEvent(lights[0], "power_level", 65535, 0), StateEvent(lights[0], "color", (1, 2, 3, 3500), None)]
+            assert lights[0].power_level == 65535 and lights[0].color == (1, 2, 3, 3500)
+
+            # nothing changed, nothing published
+            await lights[0].get_power(max_age=0)
+            assert lan.tracker.queues and all(queue.empty() for queue in lan.tracker.queues)
+            await events.aclose()
+            assert not lan.tracker.queues
+    asyncio.run(main())
+
+
+def test_slow_subscriber_loses_the_oldest_events():
+    async def main():
+        tracker = StateTracker(DeviceRegistry(), backlog=2)
+        events = tracker.events()
+        next_event = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0)
+        for value in range(3):
+            tracker.publish(StateEvent(None, "power_level", value, None))
+        assert (await next_event).value == 1
+        assert (await events.__anext__()).value == 2
+        await events.aclose()
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+import asyncio
+import json
+
+import pytest
+from lifxlan.errors import InvalidParameterException
+
+from lifxlan_asyncio.codec import pack_colors
+from lifxlan_asyncio.group import AsyncGroup, Scene
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_capture_and_apply_scene():
+    async def main():
+        async with simulated_lan(make_bulbs(3, multizone_count=1, groups=1)) as (fleet, lan):
+            await lan.get_lights()
+            group = await lan.get_devices_by_location("home")
+            assert isinstance(group, AsyncGroup) and len(group.devices) == 4
+            colors = {light: [1000 * i, 65535, 30000, 3500] for i, light in enumerate(group.devices)}
+            assert await lan.set_colors(colors) == {}
+            assert await lan.set_powers({group.devices[0]: 65535, group.devices[1]: 65535}) == {}
+
+            scene = await group.capture_scene()
+            assert len(scene) == 4
+            assert scene.colors == {light.mac_addr: tuple(color) for light, color in colors.items()}
+            assert sorted(scene.power_levels.values()) == [0, 0, 65535, 65535]
+            scene = Scene.from_dict(json.loads(json.dumps(scene.as_dict())))
+
+            assert await group.set_color([0, 0, 65535, 6500]) == {}
+            assert await group.set_power("off") == {}
+            assert await group.apply_scene(scene) == {}
+            for light in group.devices:
+                bulb = fleet.bulbs[light.mac_addr]
+                assert bulb.color == scene.colors[light.mac_addr]
+                assert bulb.power_level == scene.power_levels[light.mac_addr]
+            assert fleet.stats["rate_limited"] == 0
+
+            with pytest.raises(InvalidParameterException):
+                await group.apply_scene(Scene({group.devices[0].mac_addr: (1, 2, 3)}))
+    asyncio.run(main())
+
+
+def test_set_zone_color():
+    async def main():
+        async with simulated_lan(make_bulbs(1, multizone_count=2, zone_count=8, rate_limit=None), rate_limit=None) as (fleet, lan):
+            group = AsyncGroup(lan, await lan.get_lights())
+            assert await group.set_zone_color(2, 5, [1, 2, 3, 3500]) == {}
+            expected = pack_colors([[0, 0, 0, 0]] * 2 + [[1, 2, 3, 3500]] * 4 + [[0, 0, 0, 0]] * 2)
+            assert [bytes(b.zones) for b in fleet.bulbs.values() if b.zones] == [expected, expected]
+    asyncio.run(main())
+
+
+def test_set_zone_colors_takes_lifxlan_arguments():
+    async def main():
+        async with simulated_lan(make_bulbs(0, multizone_count=2, zone_count=4, rate_limit=None), rate_limit=None) as (fleet, lan):
+            group = AsyncGroup(lan, await lan.get_lights())
+            assert await group.set_zone_colors([[7, 7, 7, 3500]] * 2, 0, False, index=1) == {}
+            expected = pack_colors([[0, 0, 0, 0], [7, 7, 7, 3500], [7, 7, 7, 3500], [0, 0, 0, 0]])
+            assert [bytes(b.zones) for b in fleet.bulbs.values()] == [expected, expected]
+    asyncio.run(main())
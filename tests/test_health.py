@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from lifxlan_asyncio.health import MAX_BACKOFF, HealthPoller
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_polls_are_spread_across_the_interval():
+    async def main():
+        async with simulated_lan(make_bulbs(4, rate_limit=None), rate_limit=None) as (fleet, lan):
+            lights = await lan.get_lights()
+            loop = asyncio.get_running_loop()
+            for jitter in (0, 0.5):
+                poller = HealthPoller(lan.registry, interval=0.8, jitter=jitter)
+                polled = []
+                poller.schedule = lambda device, now: polled.append((device, now))
+                start = loop.time()
+                poller.start()
+                await asyncio.sleep(0.75)  # the last slot, not the next cycle
+                poller.stop()
+                assert [device for device, _ in polled] == lights
+                slot = poller.interval / len(lights)
+                for index, (_, now) in enumerate(polled):
+                    assert abs(now - start - index * slot) <= jitter * slot + 0.03
+    asyncio.run(main())
+
+
+def test_unresponsive_device_backs_off():
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), rate_limit=None) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            loop = asyncio.get_running_loop()
+            poller = HealthPoller(lan.registry, interval=10)
+            fleet.loss = 1.0
+            poller.schedule(light, loop.time())
+            await poller.in_flight[light.mac_addr]
+            health = poller.health[light.mac_addr]
+            assert health.failures == 1 and not health.online
+            assert health.next_poll - loop.time() == pytest.approx(15, abs=0.1)  # 2 intervals, less half of one
+
+            fleet.loss = 0.0
+            poller.schedule(light, loop.time())
+            assert light.mac_addr not in poller.in_flight  # still backed off
+            poller.schedule(light, health.next_poll)
+            await poller.in_flight[light.mac_addr]
+            assert health.online and health.failures == 0 and health.next_poll == 0
+            assert health.power_level == 0 and health.signal_mw == pytest.approx(fleet.bulbs[light.mac_addr].signal_mw)
+            assert health.rtt == light.rtt.srtt and health.uptime is not None
+
+            health.failures = 10
+            fleet.loss = 1.0
+            await poller.poll(light, health)
+            assert health.next_poll - loop.time() == pytest.approx(10 * (MAX_BACKOFF - 0.5), abs=0.1)
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+import asyncio
+from ipaddress import IPv4Network
+
+from lifxlan_asyncio.interfaces import LIMITED_BROADCAST_ADDR, Interface, broadcast_addrs, find_interface
+from lifxlan_asyncio.simulator import make_bulbs
+from lifxlan_asyncio.transport import AsyncTransport
+
+from conftest import simulated_lan
+
+LOOPBACK = Interface("lo", "127.0.0.1", IPv4Network("127.0.0.0/8"), "127.255.255.255")
+LAN = Interface("eth0", "192.168.1.20", IPv4Network("192.168.1.0/24"), "192.168.1.255")
+UNBINDABLE = Interface("eth1", "192.0.2.1", IPv4Network("192.0.2.0/24"), "192.0.2.255")  # not an address of this host
+
+
+def test_find_interface():
+    assert find_interface([LAN, LOOPBACK], "192.168.1.7") is LAN
+    assert find_interface([LAN, LOOPBACK], "192.168.1.255") is LAN
+    assert find_interface([LAN, LOOPBACK], "10.0.0.1") is None
+    assert find_interface([LAN], "not an address") is None
+    assert broadcast_addrs([LAN, LAN, LOOPBACK]) == ["192.168.1.255", "127.255.255.255"]
+    assert broadcast_addrs([]) == [LIMITED_BROADCAST_ADDR]
+
+
+def test_each_destination_uses_its_subnets_endpoint():
+    async def main():
+        transport = AsyncTransport()
+        try:
+            await transport.open_interfaces([LOOPBACK, UNBINDABLE])
+            assert transport.interfaces == [LOOPBACK]
+            endpoint = transport.endpoints["127.0.0.1"]
+            assert endpoint.get_extra_info("sockname")[0] == "127.0.0.1"
+            assert transport.endpoint_for("127.0.0.5") is endpoint
+            assert transport.endpoint_for("192.0.2.7") is transport.transport
+            transport.device_addrs.update({"d0:73:d5:00:00:01": "127.0.0.5", "d0:73:d5:00:00:02": "192.0.2.7"})
+            assert transport.devices_reached_by("127.255.255.255") == ["d0:73:d5:00:00:01"]
+            assert transport.devices_reached_by(LIMITED_BROADCAST_ADDR) == ["d0:73:d5:00:00:02"]
+
+            await transport.open_interfaces([])  # the interface went away
+            assert transport.endpoints == {} and endpoint.is_closing()
+            assert transport.endpoint_for("127.0.0.5") is transport.transport
+            assert transport.devices_reached_by(LIMITED_BROADCAST_ADDR) == ["d0:73:d5:00:00:01", "d0:73:d5:00:00:02"]
+        finally:
+            transport.close()
+    asyncio.run(main())
+
+
+def test_devices_are_reached_through_their_interface():
+    async def main():
+        async with simulated_lan(make_bulbs(2, rate_limit=None), rate_limit=None) as (fleet, lan):
+            transport = await lan.get_transport()
+            await transport.open_interfaces([LOOPBACK])
+            lights = await lan.get_lights()
+            assert [light.interface for light in lights] == [LOOPBACK, LOOPBACK]
+            assert transport.endpoint_for(lights[0].ip_addr) is transport.endpoints["127.0.0.1"]
+            senders = set()
+            datagram_received = fleet.datagram_received
+            fleet.datagram_received = lambda data, addr: senders.add(addr) or datagram_received(data, addr)
+            assert [await light.get_label(max_age=0) for light in lights] == ["bulb0", "bulb1"]
+            assert senders == {transport.endpoints["127.0.0.1"].get_extra_info("sockname")}
+    asyncio.run(main())
@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+from lifxlan_asyncio.inventory import INVENTORY_VERSION, load_inventory
+from lifxlan_asyncio.lifxlan_asyncio import AsyncLifxLAN
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "inventory.json")
+
+    async def main():
+        async with simulated_lan(make_bulbs(2, multizone_count=1, tile_count=1, rate_limit=None), rate_limit=None) as (fleet, lan):
+            await lan.discover_devices_sync()
+            discovered = {d.mac_addr: d for d in lan.devices}
+            await lan.refresh_all()
+            lan.save_inventory(path)
+
+            warm = AsyncLifxLAN(num_lights=len(discovered), rate_limit=None, broadcast_addrs=["127.0.0.1"], broadcast_port=fleet.port)
+            try:
+                loaded = await warm.load_inventory(path, validate=False)
+                assert {d.mac_addr for d in loaded} == set(discovered)
+                for device in loaded:
+                    original = discovered[device.mac_addr]
+                    assert type(device) == type(original)
+                    assert (device.ip_addr, device.port, device.product, device.label, device.group, device.location) == \
+                        (original.ip_addr, original.port, original.product, original.label, original.group, original.location)
+                # controlled straight away, no discovery broadcast
+                assert await asyncio.gather(*(d.get_power(max_age=0) for d in loaded)) == [0] * len(loaded)
+                assert warm.metrics.sent == len(loaded)
+                assert await warm.get_device_by_name(loaded[0].label) is loaded[0]
+            finally:
+                warm.close()
+    asyncio.run(main())
+
+
+def test_unusable_inventory_is_ignored(tmp_path):
+    missing = tmp_path / "missing.json"
+    assert load_inventory(str(missing)) == []
+    other_version = tmp_path / "other_version.json"
+    other_version.write_text(json.dumps({"version": INVENTORY_VERSION + 1, "devices": [{"mac_addr": "d0:73:d5:00:00:00", "port": 56700}]}))
+    assert load_inventory(str(other_version)) == []
+    corrupt = tmp_path / "corrupt.json"
+    corrupt.write_text("{")
+    assert load_inventory(str(corrupt)) == []
@@ -0,0 +1,94 @@
+import asyncio
+
+from lifxlan.errors import WorkflowException
+from lifxlan.msgtypes import SetPower, StatePower
+
+from lifxlan_asyncio.group import AsyncGroup
+from lifxlan_asyncio.lifxlan_asyncio import AsyncLifxLAN
+from lifxlan_asyncio.light import Light
+from lifxlan_asyncio.simulator import make_bulbs, start_fleet
+
+from conftest import simulated_lan
+
+
+def test_batches_take_devices_made_elsewhere():
+    async def main():
+        async with simulated_lan(make_bulbs(2, rate_limit=None), rate_limit=None) as (fleet, lan):
+            # not discovered by lan, and with a source id of its own
+            mac_addrs = list(fleet.bulbs)
+            lights = [Light(mac_addr, "127.0.0.1", 1, fleet.port, lan.source_id + 10) for mac_addr in mac_addrs]
+            assert await lan.set_colors({lights[0]: [1, 2, 3, 3500]}) == {}
+            assert await AsyncGroup(lan, lights).set_power("on") == {}
+            assert fleet.bulbs[mac_addrs[0]].color == (1, 2, 3, 3500)
+            assert [fleet.bulbs[mac_addr].power_level for mac_addr in mac_addrs] == [65535, 65535]
+            assert lan.metrics.device(mac_addrs[1]).requests == 1
+            await lan.set_colors({lights[1]: [4, 5, 6, 3500]}, rapid=True)
+            await asyncio.sleep(0.05)
+            assert fleet.bulbs[mac_addrs[1]].color == (4, 5, 6, 3500)
+    asyncio.run(main())
+
+
+def test_client_outlives_its_event_loop():
+    bulbs = make_bulbs(2, rate_limit=None)
+    lan = AsyncLifxLAN(num_lights=2, rate_limit=None, broadcast_addrs=["127.0.0.1"])
+
+    async def on_fleet(request, port=0):
+        fleet = await start_fleet(bulbs, port=port)
+        lan.broadcast_port = fleet.port
+        try:
+            return await request(), fleet.port
+        finally:
+            fleet.close()
+
+    async def get_power():
+        return await lan.lights[0].get_power(max_age=0)
+
+    lights, port = asyncio.run(on_fleet(lan.get_lights))
+    assert len(lights) == 2
+    lan.close()  # after its loop is gone
+    assert len(asyncio.run(on_fleet(lan.get_lights, port))[0]) == 2
+    assert asyncio.run(on_fleet(get_power, port))[0] == 0  # not even closed in between
+    lan.close()
+
+
+def test_discovery_yields_devices_as_they_answer():
+    async def main():
+        async with simulated_lan(make_bulbs(2, multizone_count=1, tile_count=1, rate_limit=None), rate_limit=None) as (fleet, lan):
+            lan.num_devices = lan.num_lights = None  # so the broadcast runs for its whole timeout
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            devices = []
+            async for device in lan.get_devices():
+                if not devices:
+                    first = loop.time() - start
+                devices.append(device)
+            assert first < 0.5 < loop.time() - start
+            assert sorted(device.mac_addr for device in devices) == sorted(fleet.bulbs)
+            assert sorted(type(device).__name__ for device in devices) == ["Light", "Light", "MultiZoneLight", "TileChain"]
+            assert set(lan.registry.devices()) == set(devices) == set(lan.lights)
+            assert all(device.product == fleet.bulbs[device.mac_addr].product for device in devices)
+    asyncio.run(main())
+
+
+def test_refresh_all_reports_the_devices_that_failed():
+    async def main():
+        async with simulated_lan(make_bulbs(3, rate_limit=None), rate_limit=None) as (fleet, lan):
+            lights = await lan.get_lights()
+            fleet.bulbs[lights[0].mac_addr].label = "renamed"
+            del fleet.bulbs[lights[1].mac_addr]
+            failures = await lan.refresh_all()
+            assert list(failures) == [lights[1]]
+            assert isinstance(failures[lights[1]], WorkflowException)
+            assert lights[0].label == "renamed"
+            assert lights[2].label == fleet.bulbs[lights[2].mac_addr].label
+    asyncio.run(main())
+
+
+def test_broadcast_with_ack_and_state():
+    async def main():
+        async with simulated_lan(make_bulbs(3, rate_limit=None), rate_limit=None) as (fleet, lan):
+            responses = await lan.broadcast_with_ack_resp(SetPower, StatePower, {"power_level": 65535})
+            assert sorted(r.target_addr for r in responses) == sorted(fleet.bulbs)
+            assert [r.power_level for r in responses] == [65535] * 3
+            assert [bulb.power_level for bulb in fleet.bulbs.values()] == [65535] * 3
+    asyncio.run(main())
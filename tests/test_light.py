@@ -0,0 +1,38 @@
+import asyncio
+
+from lifxlan_asyncio.codec import pack_colors
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+RED = [65535, 65535, 65535, 3500]
+BLUE = [43634, 65535, 65535, 3500]
+BLACK = [0, 0, 0, 0]
+
+
+def test_set_zone_colors():
+    async def main():
+        async with simulated_lan(make_bulbs(0, multizone_count=1, zone_count=100, rate_limit=None), rate_limit=None) as (fleet, lan):
+            strip = (await lan.get_multizone_lights())[0]
+            bulb = fleet.bulbs[strip.mac_addr]
+            await strip.set_zone_colors([RED] * 90, 0)  # lifxlan's (colors, duration)
+            assert bytes(bulb.zones) == pack_colors([RED] * 90 + [BLACK] * 10)  # two packets, 82 + 8 zones
+            await strip.set_zone_colors([BLUE] * 5, index=95)
+            assert bytes(bulb.zones[95 * 8:]) == pack_colors([BLUE] * 5)
+    asyncio.run(main())
+
+
+def test_set_tile_colors():
+    async def main():
+        async with simulated_lan(make_bulbs(0, tile_count=1, tiles_per_chain=5, rate_limit=None), rate_limit=None) as (fleet, lan):
+            chain = (await lan.get_tilechain_lights())[0]
+            bulb = fleet.bulbs[chain.mac_addr]
+            await chain.set_tile_colors(1, [RED] * 64 + [BLUE] * 10)  # one tile and a short one
+            assert [bytes(tile) for tile in bulb.tiles[:3]] == [pack_colors([BLACK] * 64), pack_colors([RED] * 64),
+                                                                pack_colors([BLUE] * 10 + [BLACK] * 54)]
+            await chain.set_tile_colors(2, [BLUE] * 64, 0, 3)  # lifxlan's tile_count: one packet for tiles 2-4
+            assert [bytes(tile) for tile in bulb.tiles[2:]] == [pack_colors([BLUE] * 64)] * 3
+            await chain.set_tilechain_colors([[RED] * 64] * 5, rapid=True)
+            await asyncio.sleep(0.05)
+            assert [bytes(tile) for tile in bulb.tiles] == [pack_colors([RED] * 64)] * 5
+    asyncio.run(main())
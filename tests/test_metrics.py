@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+import pytest
+from lifxlan.errors import WorkflowException
+from lifxlan.msgtypes import GetLabel, GetPower, StateLabel, StatePower
+
+from lifxlan_asyncio.metrics import Histogram
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_histogram():
+    histogram = Histogram((0.01, 0.1, 1.0))
+    assert histogram.percentile(0.5) is None
+    for value in (0.005, 0.005, 0.05, 0.5, 3.0):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 5 and snapshot["max"] == 3.0
+    assert snapshot["mean"] == pytest.approx(0.712)
+    assert snapshot["buckets"] == [(0.01, 2), (0.1, 1), (1.0, 1), (None, 1)]
+    assert snapshot["p50"] == 0.1
+    assert snapshot["p99"] == 3.0
+
+
+def test_requests_are_counted_and_hooked():
+    calls = []
+
+    def hook(mac_addr, msg_type, rtt, attempts):
+        calls.append((mac_addr, msg_type, rtt, attempts))
+        raise ValueError("a broken hook must not fail the request")
+
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), rate_limit=None, metrics_hook=hook) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            lan.metrics.reset()
+            del calls[:]
+            assert await light.req_with_resp(GetLabel, StateLabel)
+            fleet.loss = 1.0
+            with pytest.raises(WorkflowException):
+                await light.req_with_resp(GetPower, StatePower, timeout_secs=0.05, max_attempts=2)
+
+            assert [(mac_addr, msg_type, attempts) for mac_addr, msg_type, _, attempts in calls] == \
+                [(light.mac_addr, GetLabel, 1), (light.mac_addr, GetPower, 2)]
+            assert calls[0][2] > 0 and calls[1][2] is None
+            snapshot = json.loads(json.dumps(lan.metrics.snapshot()))
+            assert (snapshot["sent"], snapshot["received"], snapshot["retried"]) == (3, 1, 1)
+            device = snapshot["devices"][light.mac_addr]
+            assert (device["requests"], device["timeouts"], device["timeout_rate"]) == (2, 1, 0.5)
+            assert list(device["rtt"]) == ["GetLabel"] and device["rtt"]["GetLabel"]["count"] == 1
+    asyncio.run(main())
@@ -0,0 +1,43 @@
+import asyncio
+
+from lifxlan.msgtypes import StateLabel
+
+from lifxlan_asyncio.codec import PacketTemplate
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_state_packets_keep_the_indexes_current():
+    async def main():
+        async with simulated_lan(make_bulbs(3, groups=2, rate_limit=None), rate_limit=None) as (fleet, lan):
+            lights = await lan.get_lights()
+            assert (await lan.get_device_by_name("bulb0")).mac_addr == "d0:73:d5:00:00:00"
+            assert len((await lan.get_devices_by_group("group0")).devices) == 2
+            sent = lan.metrics.sent
+            assert lan.registry.unknown("label") == []
+            assert lan.registry.get_by_label("bulb1") and lan.registry.get_by_group("group1")
+            assert lan.metrics.sent == sent  # lookups are answered from the indexes
+
+            bulb = fleet.bulbs[lights[0].mac_addr]
+            bulb.label, bulb.group = "porch", "outside"
+            await lights[0].get_label(max_age=0)
+            await lights[0].get_group(max_age=0)
+            assert lan.registry.get_by_label("porch") == [lights[0]]
+            assert lan.registry.get_by_label("bulb0") == []
+            assert lan.registry.get_by_group("outside") == [lights[0]]
+            assert lights[0] not in lan.registry.get_by_group("group0")
+
+            # a StateLabel answering another client, as the listener would pick it up
+            other = fleet.bulbs[lights[1].mac_addr]
+            other.label = "hall"
+            packet = other.encode(StateLabel, lan.source_id + 10, 0, other.get_label(b"")[0][1])
+            lan.transport.dispatch(packet, ("127.0.0.1", fleet.port), observe_only=True)
+            assert lan.registry.get_by_label("hall") == [lights[1]]
+            assert lan.registry.get_by_label("bulb1") == []
+
+            # devices that were never discovered stay out of the indexes
+            foreign = PacketTemplate("d0:73:d5:ff:ff:ff", lan.source_id).encode(StateLabel, 0, {"label": "stranger"})
+            lan.transport.dispatch(foreign.packed_message, ("127.0.0.1", fleet.port), observe_only=True)
+            assert lan.registry.get_by_label("stranger") == []
+    asyncio.run(main())
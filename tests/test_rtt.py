@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from lifxlan.device import DEFAULT_ATTEMPTS, DEFAULT_TIMEOUT
+
+from lifxlan_asyncio.rtt import MAX_RTO, MIN_RTO, RttEstimator
+from lifxlan_asyncio.simulator import make_bulbs
+
+from conftest import simulated_lan
+
+
+def test_timeouts_before_any_sample():
+    assert RttEstimator().timeouts() == [DEFAULT_TIMEOUT] * DEFAULT_ATTEMPTS
+
+
+def test_timeouts_double_until_the_budget_is_spent():
+    rtt = RttEstimator()
+    for _ in range(10):
+        rtt.update(0.01)
+    assert rtt.rto == MIN_RTO
+    timeouts = rtt.timeouts(budget=1)
+    assert timeouts == pytest.approx([0.1, 0.2, 0.4, 0.3])
+    assert sum(timeouts) == pytest.approx(1)
+
+
+def test_timeouts_are_capped():
+    rtt = RttEstimator()
+    rtt.update(10)
+    assert rtt.rto == MAX_RTO
+    assert rtt.timeouts(budget=10) == pytest.approx([MAX_RTO, MAX_RTO, 2])
+
+
+def test_update_smooths():
+    rtt = RttEstimator()
+    rtt.update(0.2)
+    assert (rtt.srtt, rtt.rttvar) == pytest.approx((0.2, 0.1))
+    rtt.update(0.6)
+    assert (rtt.srtt, rtt.rttvar) == pytest.approx((0.25, 0.175))
+    assert rtt.samples == 2
+
+
+def test_lost_request_is_retransmitted_on_the_measured_rtt():
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), latency=0.01, rate_limit=None) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            for _ in range(5):
+                await light.get_power(max_age=0)
+            assert light.rtt.rto < DEFAULT_TIMEOUT / 2
+            fleet.loss = 1.0
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            request = asyncio.ensure_future(light.get_power(max_age=0))
+            await asyncio.sleep(0.02)
+            fleet.loss = 0.0
+            assert await request == 0
+            assert loop.time() - start < DEFAULT_TIMEOUT / 2
+            assert lan.metrics.device(light.mac_addr).retried == 1
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from lifxlan.errors import WorkflowException
+from lifxlan.message import BROADCAST_MAC
+from lifxlan.msgtypes import GetLabel, GetPower, StateLabel, StatePower
+
+from lifxlan_asyncio.codec import PacketTemplate
+from lifxlan_asyncio.simulator import make_bulbs
+from lifxlan_asyncio.transport import AsyncTransport
+
+from conftest import simulated_lan
+
+MAC = "d0:73:d5:00:00:01"
+
+
+def test_replies_reach_the_request_they_answer():
+    async def main():
+        async with simulated_lan(make_bulbs(5, rate_limit=None), rate_limit=None) as (fleet, lan):
+            lights = await lan.get_lights()
+            labels = await asyncio.gather(*(light.get_label(max_age=0) for light in lights for _ in range(4)))
+            assert labels == [fleet.bulbs[light.mac_addr].label for light in lights for _ in range(4)]
+    asyncio.run(main())
+
+
+def test_more_concurrent_requests_than_sequence_numbers():
+    async def main():
+        async with simulated_lan(make_bulbs(1, rate_limit=None), latency=0.02, rate_limit=None) as (fleet, lan):
+            light = (await lan.get_lights())[0]
+            results = await asyncio.gather(*(light.get_power(max_age=0) for _ in range(300)), return_exceptions=True)
+            assert [r for r in results if isinstance(r, Exception)] == []
+            assert not light.breaker.failures
+            assert lan.transport.seq_nums_in_use == {} and lan.transport.subscriptions == {}
+    asyncio.run(main())
+
+
+def test_sequence_numbers_wrap():
+    transport = AsyncTransport()
+    transport.seq_nums[MAC] = 254
+    assert [transport.next_seq_num(MAC) for _ in range(3)] == [255, 0, 1]
+    assert transport.next_seq_num(BROADCAST_MAC) == 0  # counted per target
+
+
+def test_sequence_numbers_in_use_are_skipped():
+    transport = AsyncTransport()
+    transport.seq_nums[MAC] = 255
+    with transport.subscribe(MAC, 0, 1):
+        assert transport.next_seq_num(MAC) == 1
+    transport.seq_nums[MAC] = 255
+    assert transport.next_seq_num(MAC) == 0
+
+
+def test_live_subscription_is_not_overwritten():
+    transport = AsyncTransport()
+    with transport.subscribe(MAC, 7, 1):
+        with pytest.raises(WorkflowException):
+            transport.subscribe(MAC, 7, 1)
+
+
+def test_acquire_waits_for_a_free_sequence_number():
+    async def main():
+        transport = AsyncTransport()
+        subscriptions = [transport.subscribe(MAC, seq_num, 1) for seq_num in range(256)]
+        acquire = asyncio.ensure_future(transport.acquire_seq_num(MAC))
+        await asyncio.sleep(0.01)
+        assert not acquire.done()
+        subscriptions[17].close()
+        assert await asyncio.wait_for(acquire, 1) == 17
+    asyncio.run(main())
+
+
+def test_unicast_replies_stay_out_of_broadcast_subscriptions():
+    transport = AsyncTransport()
+    unicast = transport.subscribe(MAC, 5, 100)
+    broadcast = transport.subscribe(BROADCAST_MAC, 5, 101)
+    addr = ("127.0.0.1", 56700)
+    transport.dispatch(PacketTemplate(MAC, 100).encode(StatePower, 5, {"power_level": 1}).packed_message, addr)
+    transport.dispatch(PacketTemplate(MAC, 101).encode(StatePower, 5, {"power_level": 2}).packed_message, addr)
+    transport.dispatch(PacketTemplate(MAC, 102).encode(StatePower, 5, {"power_level": 3}).packed_message, addr)
+    assert [r.power_level for r, _ in [unicast.responses.get_nowait()]] == [1]
+    assert [r.power_level for r, _ in [broadcast.responses.get_nowait()]] == [2]
+    assert unicast.responses.empty() and broadcast.responses.empty()
+    assert transport.metrics.dropped == 1
+
+
+def test_broadcasts_use_their_own_source_id():
+    async def main():
+        async with simulated_lan(make_bulbs(3, rate_limit=None), rate_limit=None) as (fleet, lan):
+            assert lan.broadcast_source_id != lan.source_id
+            lights = await lan.get_lights()
+            light = lights[0]
+            # same sequence number for a broadcast and a unicast in flight together
+            lan.transport.seq_nums[BROADCAST_MAC] = lan.transport.seq_nums[light.mac_addr] = 40
+            responses, label = await asyncio.gather(
+                lan.broadcast_with_resp(GetPower, StatePower, timeout_secs=0.2),
+                light.req_with_resp(GetLabel, StateLabel))
+            assert sorted(r.target_addr for r in responses) == sorted(light.mac_addr for light in lights)
+            assert label.label == fleet.bulbs[light.mac_addr].label
+    asyncio.run(main())